@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 
@@ -25,11 +26,28 @@ def process_args():
                         'number of workers to use for parallel analysis '
                         '(default number equals CPU core count)',
                         widget='IntegerField', gooey_options={'min': 1})
+    parser.add_argument('--num-flow-workers', type=int, default=1,
+                        help='Number of workers, each with its own optical '
+                             'flow model instance, to use for parallel '
+                             'optical flow computation (default 1)',
+                        widget='IntegerField', gooey_options={'min': 1})
     parser.add_argument('--subdirs', help='Process files in root directory '
                         'subfolders instead', action='store_true')
     parser.add_argument('--overwrite-flow', action='store_true',
                         help='Recompute optical flow even if preexisting '
                              'optical flow file is found for an image series')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record the wall time, CPU time and process '
+                             'peak memory of each stage of each image series '
+                             'in its output directory and summarize them in '
+                             'the root directory')
+    parser.add_argument('--profile-stage', type=str,
+                        help='Stage to also profile with cProfile when '
+                             'profiling, e.g. inference, saved as .prof '
+                             'files in each output directory')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print progress information, such as the number '
+                             'of optical flow refinement iterations used')
     args = parser.parse_args()
 
     return args
@@ -52,16 +70,29 @@ def main():
     assert os.path.isfile(args.config), 'Invalid config file path provided.'
     assert args.num_workers is None or args.num_workers > 0, (
         'Invalid number of workers provided.')
+    assert args.num_flow_workers > 0, ('Invalid number of optical flow '
+                                       'workers provided.')
+
+    logging.basicConfig(format='%(name)s: %(message)s',
+                        level=logging.INFO if args.verbose else
+                        logging.WARNING)
 
     with open(args.config) as f:
         config = yaml.safe_load(f)
 
-    process_files(args.root_dir, config, args.num_workers, args.subdirs,
-                  args.overwrite_flow)
+    failed = process_files(args.root_dir, config, args.num_workers,
+                           args.subdirs, args.overwrite_flow,
+                           args.num_flow_workers, args.profile,
+                           args.profile_stage)
+    if len(failed) != 0:
+        print(f'{len(failed)} tasks failed:')
+        for task in failed:
+            print(f'  {task.name}: {str(task.error)}')
+        return 1
 
     return 0
 
 
 if __name__ == "__main__":
     __spec__ = None  # pdb multiprocessing support
-    main()
+    sys.exit(main())
@@ -1,12 +1,19 @@
+import atexit
 import csv
-import math
+import io
+import json
 import os
 import warnings
-from itertools import chain
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
 
 import cv2
 
+from jupyter_client import KernelManager
+
 import matplotlib.pyplot as plt
 
 import nbconvert
@@ -16,15 +23,42 @@ import nbformat
 
 import numpy as np
 
-from physt import polar
+import pandas as pd
 
-import scipy.stats
+import rainbow
+from rainbow.manifest import Manifest, get_fingerprint
+from rainbow.optical_flow.optical_flow import flows_to_imgs
+from rainbow.profiling import profile_stage
+from rainbow.util import (VideoWriter, atomic_output, comb_imgs,
+                          get_flow_path, load_optical_flow, load_std_imgs,
+                          save_img_ser)
 
 SENTINEL = 'STOP'
 NOTEBOOK_DIR = 'misc/notebooks'
+VID_FILENAME = 'Video'
+DEFAULT_ANALYSIS_ENGINE = 'notebook'
+DEFAULT_HEATMAP_RENDERER = 'matplotlib'
+DEFAULT_QUIVER_RENDERER = 'matplotlib'
+ARROW_HEAD_LEN = 0.3  # relative to the arrow length
+ARROW_HEAD_ANGLE = np.deg2rad(25)
+DEFAULT_NUM_R_BINS = 10
+DEFAULT_NUM_PHI_BINS = 16
+ANALYSIS_STAGES = ('stats', 'scatter_plots', 'flow_imgs', 'heatmaps',
+                   'quiver_plots', 'polar_plots')
+# files in an output directory read by the analysis stages
+STAGE_INPUTS = (rainbow.OPTICAL_FLOW_FILENAME,
+                rainbow.OPTICAL_FLOW_ARCHIVE_FILENAME,
+                rainbow.RAW_IMGS_DIR_NAME, f'{rainbow.METADATA_FILENAME}.json')
+RENDER_CHUNK_SIZE = 2  # frames in shared memory per render pool process
+
+polar_figs = {}  # persistent polar plot figures of this process
+worker_pools = {}  # kernel and render pools of this process
+KERNEL_TIMEOUT = 60
+KERNEL_PRELOAD_CODE = ('import cv2, matplotlib.pyplot, pandas, yaml, rainbow, '
+                       'rainbow.data_analysis, rainbow.util')
 
 
-def analyze_data(queue, config):
+def analyze_data(queue, config, html_queue=None, kernel_pool=None):
     """Performs data analysis.
 
     Receives directories from worker processes via queue and generates an
@@ -34,72 +68,614 @@ def analyze_data(queue, config):
         queue (multiprocessing.Queue): The queue that will be used to receive
             directory paths from workers.
         config (string): The path to a .yaml configuration file.
+        html_queue (multiprocessing.Queue, optional): The queue of an html
+            exporter (see export_html) to hand executed reports to. If None,
+            reports are exported in this process. Defaults to None.
+        kernel_pool (KernelPool, optional): The kernels to execute reports
+            with. If None, a pool of config['kernel_pool_size'] kernels is
+            started for this call, or a new kernel is started per report if
+            the size is missing or 0. Defaults to None.
 
     Returns:
         int: 0 when data analysis has successfully finished.
     """
+    engine = config.get('analysis_engine', DEFAULT_ANALYSIS_ENGINE)
+    own_pool = (kernel_pool is None and engine == 'notebook' and config.get(
+                'kernel_pool_size', 0) > 0)
+    if own_pool:
+        kernel_pool = KernelPool(config['kernel_pool_size'])
+    render_pool = (RenderPool(config['render_workers']) if engine == 'native'
+                   and config.get('render_workers', 1) > 1 else None)
+
+    try:
+        while True:
+            output_dir = queue.get()
+            if output_dir == SENTINEL:
+                # put it back so that other consumers see it
+                queue.put(SENTINEL)
+                return 0
+
+            if engine == 'native':
+                try:
+                    run_analysis(output_dir, config, render_pool=render_pool)
+                except Exception as e:
+                    msg = (f'Could not analyze data in \'{output_dir}\', '
+                           f'reason: {str(e)}.')
+                    warnings.warn(msg, UserWarning)
+            elif engine == 'notebook':
+                gen_report(output_dir, config['report_path'],
+                           kernel_pool=kernel_pool, html_queue=html_queue,
+                           incremental=config.get('incremental_analysis',
+                                                  False),
+                           params=get_report_params(config))
+            else:
+                msg = f'Chosen analysis engine ({engine}) not supported.'
+                raise ValueError(msg)
+    finally:
+        if own_pool:
+            kernel_pool.shutdown()
+        if render_pool is not None:
+            render_pool.shutdown()
+
+
+class KernelPool:
+    """Pool of started jupyter kernels with rainbow pre-imported.
+
+    Reusing kernels avoids paying the kernel startup and import cost for
+    every generated report. Each report is executed in a fresh namespace.
+    """
+    def __init__(self, size=1, kernel_name='python3'):
+        """Initializes class instance and starts the kernels.
+
+        Args:
+            size (int, optional): The number of kernels. Defaults to 1.
+            kernel_name (string, optional): The name of the kernels.
+                Defaults to 'python3'.
+        """
+        self.kernel_name = kernel_name
+        self.kms = deque(self.start_kernel() for _ in range(size))
+
+    def start_kernel(self):
+        """Starts a kernel and pre-imports the modules used by reports.
+
+        Returns:
+            jupyter_client.KernelManager: The manager of the started kernel.
+        """
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        self.run(km, KERNEL_PRELOAD_CODE)
+
+        return km
+
+    def acquire(self, output_dir):
+        """Takes a kernel from the pool and prepares it to execute a report.
+
+        The namespace of the kernel is reset and its working directory is set
+        to output_dir. Kernels that died are replaced.
+
+        Args:
+            output_dir (string): The path to the output directory.
+
+        Returns:
+            jupyter_client.KernelManager: The manager of the kernel.
+        """
+        km = self.kms.popleft()
+        if not km.is_alive():
+            km.shutdown_kernel(now=True)
+            km = self.start_kernel()
+        self.run(km, f'%reset -f\nimport os\nos.chdir({output_dir!r})')
+
+        return km
+
+    def release(self, km):
+        """Returns a kernel to the pool.
+
+        Args:
+            km (jupyter_client.KernelManager): The manager of the kernel.
+        """
+        self.kms.append(km)
+
+    def shutdown(self):
+        """Shuts down all kernels in the pool."""
+        while self.kms:
+            self.kms.popleft().shutdown_kernel(now=True)
+
+    @staticmethod
+    def run(km, code):
+        """Executes code in a kernel, discarding its output.
+
+        Args:
+            km (jupyter_client.KernelManager): The manager of the kernel.
+            code (string): The code to execute.
+        """
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=KERNEL_TIMEOUT)
+            kc.execute_interactive(code, store_history=False,
+                                   timeout=KERNEL_TIMEOUT,
+                                   output_hook=lambda msg: None)
+        finally:
+            kc.stop_channels()
+
+
+def export_html(html_queue):
+    """Exports executed reports as html files.
+
+    Receives (output directory, executed report path, report fingerprint)
+    tuples via html_queue until SENTINEL is received, so that html export
+    runs in a separate process from report execution.
+
+    Args:
+        html_queue (multiprocessing.Queue): The queue that will be used to
+            receive executed reports.
+
+    Returns:
+        int: 0 when html export has successfully finished.
+    """
     while True:
-        output_dir = queue.get()
-        if output_dir == SENTINEL:
-            # put it back so that other consumers see it
-            queue.put(SENTINEL)
+        item = html_queue.get()
+        if item == SENTINEL:
             return 0
 
-        gen_report(output_dir, config['report_path'])
+        export_report(item)
+
+
+def run_analysis(output_dir, config=None, dpi=1000, render_pool=None,
+                 stages=ANALYSIS_STAGES, record=True):
+    """Analyzes the data in output_dir.
+
+    Runs the same analysis as the base report notebook, generating the
+    statistics files, scatter plots, flow and combined images, heatmaps,
+    quiver plots, polar plots and videos in output_dir, without executing
+    a jupyter notebook. Each output is written atomically and each stage is
+    recorded in the manifest of output_dir (see rainbow.manifest.Manifest).
+    If config['incremental_analysis'] is set, stages whose inputs and
+    configuration are unchanged since they were last run are skipped. Only
+    the data needed by the chosen stages is loaded.
+
+    Args:
+        output_dir (string): The path to an output directory containing
+            optical flow, raw images and metadata.
+        config (dict, optional): The loaded .yaml configuration, used to
+            select the plot renderers. If None, the defaults are used.
+            Defaults to None.
+        dpi (int, optional): The dots per inch of the saved scatter plots.
+            Defaults to 1000.
+        render_pool (RenderPool, optional): The processes to render the
+            frames of the matplotlib plots with. If None, frames are rendered
+            in this process. Defaults to None.
+        stages (iterable, optional): The stages to run, see ANALYSIS_STAGES.
+            Defaults to ANALYSIS_STAGES.
+        record (bool, optional): If True, records each completed stage in the
+            manifest of output_dir. Set to False when stages of the same
+            output directory run concurrently, and record the returned
+            stages afterwards (see record_stages). Defaults to True.
+
+    Raises:
+        ValueError: If a chosen plot renderer is not supported.
+
+    Returns:
+        dict: The fingerprint and outputs of each completed stage.
+    """
+    config = config or {}
+    heatmap_renderer = config.get('heatmap_renderer',
+                                  DEFAULT_HEATMAP_RENDERER)
+    if heatmap_renderer not in ['matplotlib', 'lut']:
+        msg = f'Chosen heatmap renderer ({heatmap_renderer}) not supported.'
+        raise ValueError(msg)
+    quiver_renderer = config.get('quiver_renderer', DEFAULT_QUIVER_RENDERER)
+    if quiver_renderer not in ['matplotlib', 'raster']:
+        msg = f'Chosen quiver renderer ({quiver_renderer}) not supported.'
+        raise ValueError(msg)
+
+    manifest = Manifest(output_dir)
+    inputs = [os.path.join(output_dir, path) for path in STAGE_INPUTS]
+    stage_cfgs = {'stats': [], 'scatter_plots': [dpi],
+                  'flow_imgs': [config.get('flow_img_max'),
+                                config.get('flow_img_norm', 'frame')],
+                  'heatmaps': [heatmap_renderer, config.get('heatmap_max')],
+                  'quiver_plots': [quiver_renderer,
+                                   config.get('quiver_overlay'),
+                                   config.get('quiver_dims')],
+                  'polar_plots': []}
+    fprints = {stage: get_fingerprint(stage, *stage_cfgs[stage],
+                                      paths=inputs) for stage in stages}
+    stages = [stage for stage, fprint in fprints.items() if not (
+              config.get('incremental_analysis') and manifest.is_current(
+                  stage, fprint))]
+    records = {}
+    if len(stages) == 0:
+        return records
+
+    with open(os.path.join(output_dir, f'{rainbow.METADATA_FILENAME}.json')
+              ) as f:
+        metadata = json.load(f)
+
+    data = defaultdict(list)
+    metrics = not set(stages).isdisjoint(['stats', 'scatter_plots',
+                                          'polar_plots'])
+    with profile_stage('load_data'):
+        data['preds'] = load_optical_flow(get_flow_path(output_dir))
+        if metrics or 'flow_imgs' in stages or (
+                'quiver_plots' in stages and quiver_renderer == 'raster' and
+                config.get('quiver_overlay')):
+            data['raw_imgs'] = load_std_imgs(os.path.join(
+                output_dir, rainbow.RAW_IMGS_DIR_NAME),
+                metadata['calibration_um'])
+    if metrics:
+        with profile_stage('metrics'):
+            gen_base_metrics(data)
+    if 'stats' in stages:
+        with profile_stage('stats'):
+            outputs = []
+            for key, unit, filename in zip(['mag_stats', 'dirn_stats'],
+                                           ['um', 'deg'],
+                                           [rainbow.MAG_STATS_FILENME,
+                                            rainbow.DIRN_STATS_FILENME]):
+                outputs.append(f'{filename}.csv')
+                with atomic_output(os.path.join(output_dir, outputs[-1])
+                                   ) as csv_path:
+                    save_stats(data[key], csv_path, unit)
+            outputs.append(f'{rainbow.MAG_STATS_FILENME}_and_'
+                           f'{rainbow.DIRN_STATS_FILENME}.csv')
+            with atomic_output(os.path.join(output_dir, outputs[-1])
+                               ) as csv_path:
+                pd.merge(*(pd.read_csv(os.path.join(output_dir, path)) for
+                           path in outputs[:2])).to_csv(csv_path)
+        records['stats'] = outputs
+        if record:
+            manifest.record('stats', fprints['stats'], outputs)
+
+    if 'scatter_plots' in stages:
+        with profile_stage('scatter_plots'):
+            outputs = []
+            for scatter, key, filename in zip(
+                    [mag_scatter, dirn_scatter], ['mag_stats', 'dirn_stats'],
+                    [rainbow.MAG_SCATTER_FILENAME,
+                     rainbow.DIRN_SCATTER_FILENAME]):
+                outputs.append(f'{filename}.png')
+                scatter([s['mean'] for s in data[key]])
+                with atomic_output(os.path.join(output_dir, outputs[-1])
+                                   ) as img_path:
+                    plt.savefig(img_path, dpi=dpi)
+                plt.close()
+        records['scatter_plots'] = outputs
+        if record:
+            manifest.record('scatter_plots', fprints['scatter_plots'], outputs)
+
+    if 'flow_imgs' in stages:
+        with profile_stage('flow_imgs'):
+            data['flow_imgs'] = flows_to_imgs(
+                data['preds'], config.get('flow_img_max'), config.get(
+                    'flow_img_norm', 'frame') == 'global')
+            data['comb_imgs'] = [comb_imgs(img1, img2) for img1, img2 in
+                                 zip(data['raw_imgs'], data['flow_imgs'])]
+            outputs = [rainbow.FLOW_IMGS_DIR_NAME,
+                       rainbow.COMB_IMGS_DIR_NAME]
+            for dir_name, imgs in zip(outputs, [data['flow_imgs'],
+                                                data['comb_imgs']]):
+                with atomic_output(os.path.join(output_dir, dir_name),
+                                   is_dir=True) as img_ser_dir:
+                    save_img_ser(imgs, img_ser_dir, False)
+                    with VideoWriter(os.path.join(img_ser_dir, VID_FILENAME)
+                                     ) as video:
+                        for img in imgs:
+                            video.write(img)
+        records['flow_imgs'] = outputs
+        if record:
+            manifest.record('flow_imgs', fprints['flow_imgs'], outputs)
+
+    if heatmap_renderer == 'matplotlib':
+        heatmaps = (save_heatmaps, {'pool': render_pool})
+    else:
+        heatmaps = (save_lut_heatmaps, {'max_mag': config.get(
+                    'heatmap_max')})
+    if quiver_renderer == 'matplotlib':
+        quivers = (save_quiver_plots, {'pool': render_pool})
+    else:
+        quivers = (save_raster_quiver_plots, {
+                   'imgs': data['raw_imgs'] if config.get('quiver_overlay')
+                   else None, 'dims': config.get('quiver_dims')})
+    for stage, dir_name, save_plots, kwargs, fps in zip(
+            ['heatmaps', 'quiver_plots', 'polar_plots'],
+            [rainbow.HEATMAPS_DIR_NAME, rainbow.QUIVER_PLOTS_DIR_NAME,
+             rainbow.POLAR_PLOTS_DIR_NAME],
+            [heatmaps[0], quivers[0], save_polar_plots],
+            [heatmaps[1], quivers[1], {'mpp': metadata['calibration_um'],
+                                       'pool': render_pool}],
+            [5, 5, 1]):
+        if stage not in stages:
+            continue
+        if stage == 'polar_plots':
+            kwargs['max_mag'] = max(s['max'] for s in data['mag_stats'])
+        with profile_stage(stage, renderer=save_plots.__name__):
+            with atomic_output(os.path.join(output_dir, dir_name),
+                               is_dir=True) as plots_dir:
+                with VideoWriter(os.path.join(plots_dir, VID_FILENAME), fps
+                                 ) as video:
+                    save_plots(data['preds'], plots_dir, video=video,
+                               **kwargs)
+        records[stage] = [dir_name]
+        if record:
+            manifest.record(stage, fprints[stage], [dir_name])
+    data['preds'].close()
+
+    return {stage: {'fingerprint': fprints[stage], 'outputs': outputs} for
+            stage, outputs in records.items()}
+
+
+def run_stages(output_dir, config, stages):
+    """Runs analysis stages of output_dir in a TaskGraph worker process.
+
+    See run_analysis. The stages are not recorded in the manifest of
+    output_dir, so that stages of the same output directory can run
+    concurrently. If config['render_workers'] is greater than 1, frames are
+    rendered with a RenderPool kept for the lifetime of the process. Errors
+    are raised, so that the task fails.
+
+    Args:
+        output_dir (string): The path to an output directory containing
+            optical flow, raw images and metadata.
+        config (dict): The loaded .yaml configuration.
+        stages (iterable): The stages to run, see ANALYSIS_STAGES.
+
+    Returns:
+        dict: The fingerprint and outputs of each completed stage.
+    """
+    render_pool = (get_worker_pool(RenderPool, config['render_workers']) if
+                   config.get('render_workers', 1) > 1 else None)
+
+    return run_analysis(output_dir, config, render_pool=render_pool,
+                        stages=stages, record=False)
+
+
+def record_stages(output_dir, *records):
+    """Records completed stages in the manifest of output_dir.
+
+    Args:
+        output_dir (string): The path to the output directory.
+        *records (dict): The fingerprint and outputs of each completed
+            stage, see run_analysis.
+    """
+    manifest = Manifest(output_dir)
+    for stage_records in records:
+        for stage, record in stage_records.items():
+            manifest.record(stage, record['fingerprint'], record['outputs'])
+
 
+def get_worker_pool(pool_cls, size):
+    """Gets a pool of this process, starting it on first use.
 
-def gen_report(output_dir, report_path, html=True):
+    The pool is shut down when the process exits.
+
+    Args:
+        pool_cls (class): The class of the pool, e.g. KernelPool or
+            RenderPool.
+        size (int): The size of the pool.
+
+    Returns:
+        object: The pool.
+    """
+    key = (pool_cls.__name__, size)
+    if key not in worker_pools:
+        worker_pools[key] = pool_cls(size)
+        atexit.register(worker_pools[key].shutdown)
+
+    return worker_pools[key]
+
+
+def gen_report(output_dir, report_path, html=True, kernel_pool=None,
+               html_queue=None, incremental=False, raise_errors=False,
+               params=None):
     """Generate a report.
 
-    Execute a jupyter notebook in output_dir.
+    Execute a jupyter notebook in output_dir. The executed notebook and html
+    file are written atomically and, if the notebook executed without
+    errors, the report is recorded in the manifest of output_dir (see
+    rainbow.manifest.Manifest).
 
     Args:
         output_dir (string): The path to the output directory.
         report_path (string): The path to the jupyter notebook.
         html (bool, optional): If True, will also save executed jupyter
             notebook as a html file in output_dir. Defaults to True.
+        kernel_pool (KernelPool, optional): The kernels to execute the
+            notebook with. If None, a new kernel is started.
+            Defaults to None.
+        html_queue (multiprocessing.Queue, optional): The queue of an html
+            exporter (see export_html) to hand the executed notebook to. If
+            None, the html file is saved in this process. Defaults to None.
+        incremental (bool, optional): If True, the notebook is not executed
+            if the report is up to date with the notebook and the data in
+            output_dir. Defaults to False.
+        raise_errors (bool, optional): If True, raises an error if the
+            notebook is not found or raised errors (once the executed
+            notebook, and html file if not handed to html_queue, are saved)
+            instead of skipping the report or warning. Defaults to False.
+        params (dict, optional): Values of notebook variables, set by a cell
+            inserted after the cell tagged 'parameters' (see
+            get_report_params). Defaults to None.
+
+    Raises:
+        FileNotFoundError: If raise_errors is set and the notebook is not
+            found.
+        RuntimeError: If raise_errors is set and the notebook raised errors.
+
+    Returns:
+        tuple: The output directory, executed notebook path and report
+            fingerprint (None if the notebook raised errors) to export the
+            report as html with (see export_report), or None if the notebook
+            was not executed.
     """
     if not os.path.isfile(report_path):
         report_path = os.path.join(os.path.abspath(os.path.dirname(
             __file__)), '..', NOTEBOOK_DIR, report_path)
         if not os.path.isfile(report_path):
-            return
+            if raise_errors:
+                msg = f'Report notebook ({report_path}) not found.'
+                raise FileNotFoundError(msg)
+            return None
+    fprint = get_fingerprint('report', html, params, paths=[os.path.join(
+                             output_dir, path) for path in STAGE_INPUTS] +
+                             [report_path])
+    if incremental and Manifest(output_dir).is_current('report', fprint):
+        return None
 
     with open(report_path) as f:
         nb = nbformat.read(f, as_version=4)
+        if params:
+            inject_params(nb, params)
         ep = ExecutePreprocessor(timeout=600, kernel_name='python3')
         ep.allow_errors = True
         gend_report_path = os.path.join(output_dir,
                                         Path(report_path).name)
+        km = (kernel_pool.acquire(os.path.abspath(output_dir)) if
+              kernel_pool is not None else None)
+        executed = False
         try:
-            ep.preprocess(nb, {'metadata': {'path': output_dir}})
+            with profile_stage('report'):
+                ep.preprocess(nb, {'metadata': {'path': output_dir}}, km=km)
+            executed = not any(output.get('output_type') == 'error' for cell
+                               in nb.cells for output in cell.get(
+                                   'outputs', []))
         except CellExecutionError:
-            msg = (f'Could not generate report, see \'{gend_report_path}\' '
-                   'for error.')
-            warnings.warn(msg, UserWarning)
+            if not raise_errors:
+                msg = (f'Could not generate report, see '
+                       f'\'{gend_report_path}\' for error.')
+                warnings.warn(msg, UserWarning)
         finally:
-            with open(gend_report_path, 'w', encoding='utf-8') as f:
-                nbformat.write(nb, f)
-            if html:
-                save_html(output_dir, gend_report_path)
+            if km is not None:
+                kernel_pool.release(km)
+            with atomic_output(gend_report_path) as tmp_path:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    nbformat.write(nb, f)
+            fprint = fprint if executed else None
+            if html and html_queue is not None:
+                html_queue.put((output_dir, gend_report_path, fprint))
+            elif html:
+                save_html(output_dir, gend_report_path, fprint)
+            elif fprint is not None:
+                Manifest(output_dir).record('report', fprint,
+                                            [Path(gend_report_path).name])
+    if raise_errors and not executed:
+        msg = (f'Report notebook raised errors, see \'{gend_report_path}\' '
+               'for error.')
+        raise RuntimeError(msg)
+
+    return output_dir, gend_report_path, fprint
+
+
+def get_report_params(config):
+    """Determines the values of the report notebook parameters.
+
+    The parameters are the configuration values also used by the native
+    analysis engine, so that both engines generate the same outputs.
+
+    Args:
+        config (dict): The loaded .yaml configuration.
+
+    Returns:
+        dict: The values of the notebook parameters.
+    """
+    return {'flow_img_max': config.get('flow_img_max'),
+            'flow_img_norm': config.get('flow_img_norm', 'frame')}
+
+
+def inject_params(nb, params):
+    """Sets notebook variables by inserting a cell in a notebook.
+
+    The cell is inserted after the cell tagged 'parameters', or at the start
+    of the notebook if there is none.
+
+    Args:
+        nb (nbformat.NotebookNode): The notebook.
+        params (dict): The values of the variables.
+    """
+    cell = nbformat.v4.new_code_cell('\n'.join(
+        f'{name} = {value!r}' for name, value in params.items()), metadata={
+        'tags': ['injected-parameters']})
+    idx = next((i + 1 for i, nb_cell in enumerate(nb.cells) if 'parameters'
+                in nb_cell.metadata.get('tags', [])), 0)
+    nb.cells.insert(idx, cell)
+
+
+def run_report(output_dir, config, html=True):
+    """Generates the report of output_dir in a TaskGraph worker process.
+
+    If config['kernel_pool_size'] is greater than 0, the report is executed
+    with a KernelPool kept for the lifetime of the process. Errors, e.g. of
+    a missing notebook or of notebook cells, are raised, so that the task
+    fails. A report whose notebook raised errors is still exported as html,
+    in this task if html is False since the export task depending on it
+    will not run.
+
+    Args:
+        output_dir (string): The path to the output directory.
+        config (dict): The loaded .yaml configuration.
+        html (bool, optional): If True, will also save executed jupyter
+            notebook as a html file in output_dir. Defaults to True.
 
+    Raises:
+        FileNotFoundError: If the notebook is not found.
+        RuntimeError: If the notebook raised errors.
 
-def save_html(output_dir, gend_report_path):
+    Returns:
+        tuple: See gen_report.
+    """
+    kernel_pool = (get_worker_pool(KernelPool, config['kernel_pool_size']) if
+                   config.get('kernel_pool_size', 0) > 0 else None)
+
+    try:
+        return gen_report(output_dir, config['report_path'], html,
+                          kernel_pool, incremental=config.get(
+                              'incremental_analysis', False),
+                          raise_errors=True,
+                          params=get_report_params(config))
+    except RuntimeError:
+        gend_report_path = os.path.join(output_dir,
+                                        Path(config['report_path']).name)
+        if not html and os.path.isfile(gend_report_path):
+            save_html(output_dir, gend_report_path)
+        raise
+
+
+def export_report(report):
+    """Exports an executed report as a html file.
+
+    Args:
+        report (tuple): The output directory, executed notebook path and
+            report fingerprint, see gen_report. If None, nothing is exported.
+    """
+    if report is None:
+        return
+
+    save_html(*report)
+
+
+def save_html(output_dir, gend_report_path, fingerprint=None):
     """Saves jupyter notebook as a html file in output_dir.
 
     Args:
         output_dir (string): The path to the output directory.
         gend_report_path (string): The path to the jupyter notebook.
+        fingerprint (string, optional): The fingerprint of the report, see
+            gen_report. If given, the report is recorded in the manifest of
+            output_dir once the html file is saved. Defaults to None.
     """
-    with open(gend_report_path) as f:
+    html_path = os.path.join(output_dir, f'{Path(gend_report_path).stem}.html')
+    with open(gend_report_path) as f, profile_stage('html'):
         nb = nbformat.read(f, as_version=4)
         exporter = nbconvert.HTMLExporter()
         exporter.exclude_input = True
         body, resources = exporter.from_notebook_node(nb)
         file_writer = nbconvert.writers.FilesWriter()
-        file_writer.write(output=body, resources=resources,
-                          notebook_name=os.path.join(output_dir, Path(
-                                                     gend_report_path).stem))
+        with atomic_output(html_path) as tmp_path:
+            file_writer.write(output=body, resources=resources,
+                              notebook_name=os.path.splitext(tmp_path)[0])
+    if fingerprint is not None:
+        Manifest(output_dir).record('report', fingerprint, [
+            Path(gend_report_path).name, Path(html_path).name])
 
 
 def mag_scatter(mags):
@@ -132,7 +708,8 @@ def dirn_scatter(dirns):
     plt.ylim(0, max(dirns) * 1.5)
 
 
-def save_heatmaps(preds, output_dir, step=0, dpi=1000):
+def save_heatmaps(preds, output_dir, step=0, dpi=1000, video=None,
+                  pool=None):
     """Saves heatmaps.
 
     Writes images visualizing the magnitude of optical flow of an image
@@ -145,25 +722,102 @@ def save_heatmaps(preds, output_dir, step=0, dpi=1000):
             visualizing heatmaps. Defaults to 0.
         dpi (int, optional): The dots per inch of the saved heatmap images.
             Defaults to 1000.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+        pool (RenderPool, optional): The processes to render the images
+            with. If None, images are rendered in this process. Defaults to
+            None.
     """
+    render_frames(render_heatmap, preds, output_dir, video, pool, step=step,
+                  dpi=dpi)
+
+
+def render_heatmap(pred, path, step=0, dpi=1000, return_img=False):
+    """Renders the heatmap of the optical flow of a frame.
+
+    Args:
+        pred (numpy.ndarray): The optical flow of a frame.
+        path (string): The path of the image to create.
+        step (int, optional): The amount of infomation discarded when
+            visualizing the heatmap. Defaults to 0.
+        dpi (int, optional): The dots per inch of the saved image. Defaults
+            to 1000.
+        return_img (bool, optional): If True, returns the rendered image.
+            Defaults to False.
+
+    Returns:
+        numpy.ndarray: The rendered image if return_img is True, else None.
+    """
+    plt.xticks([])
+    plt.yticks([])
+    plt.Axes(plt.figure(frameon=False), [0, 0, 1, 1])
+    plt.axis('off')
+    pred = np.copy(pred)
+    pred[:, :, 1] = pred[:, :, 1] * -1
+    u, v = ((pred[::step, ::step, 0].astype(np.float32),
+            pred[::step, ::step, 1].astype(float)) if step != 0 else
+            (pred[:, :, 0].astype(float), pred[:, :, 1].astype(float)))
+    mag = cv2.cartToPolar(u, v, angleInDegrees=1)
+    plt.pcolormesh(mag[0], cmap='hot')
+    img = save_fig(path, dpi, return_img=return_img)
+    plt.close()
+
+    return img
+
+
+def save_lut_heatmaps(preds, output_dir, max_mag=None, cmap='hot',
+                      video=None):
+    """Saves heatmaps rendered with a colormap lookup table.
+
+    Writes images visualizing the magnitude of optical flow of an image
+    sequence to output_dir, at the resolution of the optical flow and in the
+    orientation of the image sequence. Magnitudes are mapped straight to
+    pixels through a colormap lookup table, with a colour scale shared by all
+    images, without drawing a matplotlib figure.
+
+    Args:
+        preds (list): The optical flow across an image sequence.
+        output_dir (string): The path to the output directory.
+        max_mag (float, optional): The magnitude, in pixels, mapped to the
+            last colour of the colormap. If None, the maximum magnitude across
+            the image sequence is used. Defaults to None.
+        cmap (string, optional): The name of the matplotlib colormap.
+            Defaults to 'hot'.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+    """
+    if max_mag is None:
+        max_mag = max((float(np.nanmax(cart_to_polar(pred)[0])) for pred in
+                       preds), default=0)
+    lut = get_colormap_lut(cmap)
+    scale = (len(lut) - 1) / max_mag if max_mag > 0 else 0
     for i, pred in enumerate(preds):
-        plt.xticks([])
-        plt.yticks([])
-        plt.Axes(plt.figure(frameon=False), [0, 0, 1, 1])
-        plt.axis('off')
-        pred = np.copy(pred)
-        pred[:, :, 1] = pred[:, :, 1] * -1
-        u, v = ((pred[::step, ::step, 0].astype(np.float32),
-                pred[::step, ::step, 1].astype(float)) if step != 0 else
-                (pred[:, :, 0].astype(float), pred[:, :, 1].astype(float)))
-        mag = cv2.cartToPolar(u, v, angleInDegrees=1)
-        plt.pcolormesh(mag[0], cmap='hot')
+        idxs = np.nan_to_num(cart_to_polar(pred)[0] * scale)
+        idxs = np.clip(idxs, 0, len(lut) - 1).astype(np.uint8)
+        img = lut[idxs]
         path = os.path.join(output_dir, 'Image_{}.png'.format(i))
-        plt.savefig(path, dpi=dpi, bbox_inches=0)
-        plt.close()
+        cv2.imwrite(path, img)
+        if video is not None:
+            video.write(img)
+
 
+def get_colormap_lut(cmap, size=256):
+    """Builds a lookup table of the colours of a colormap.
 
-def save_quiver_plots(preds, output_dir, step=70, dpi=1000):
+    Args:
+        cmap (string): The name of the matplotlib colormap.
+        size (int, optional): The number of colours. Defaults to 256.
+
+    Returns:
+        numpy.ndarray: The colours as BGR uint8 values with shape [size, 3].
+    """
+    colours = plt.get_cmap(cmap)(np.linspace(0, 1, size))[:, 2::-1]
+
+    return np.round(colours * 255).astype(np.uint8)
+
+
+def save_quiver_plots(preds, output_dir, step=70, dpi=1000, video=None,
+                      pool=None):
     """Saves quiver plots.
 
     Writes images visualizing the direction of optical flow of an image
@@ -176,41 +830,188 @@ def save_quiver_plots(preds, output_dir, step=70, dpi=1000):
             the quiver plots.
         dpi (int, optional): The dots per inch of the saved quiver plot images.
             Defaults to 1000.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+        pool (RenderPool, optional): The processes to render the images
+            with. If None, images are rendered in this process. Defaults to
+            None.
+    """
+    render_frames(render_quiver_plot, preds, output_dir, video, pool,
+                  step=step, dpi=dpi)
+
+
+def render_quiver_plot(pred, path, step=70, dpi=1000, return_img=False):
+    """Renders the quiver plot of the optical flow of a frame.
+
+    Args:
+        pred (numpy.ndarray): The optical flow of a frame.
+        path (string): The path of the image to create.
+        step (int, optional): The pixel seperation of the vectors visualized in
+            the quiver plot.
+        dpi (int, optional): The dots per inch of the saved image. Defaults
+            to 1000.
+        return_img (bool, optional): If True, returns the rendered image.
+            Defaults to False.
+
+    Returns:
+        numpy.ndarray: The rendered image if return_img is True, else None.
+    """
+    plt.xticks([])
+    plt.yticks([])
+    plt.Axes(plt.figure(frameon=False), [0, 0, 1, 1])
+    plt.axis('off')
+    pred = np.copy(pred)
+    pred[:, :, 1] = pred[:, :, 1] * -1
+    plt.quiver(np.arange(0, pred.shape[1], step), np.arange(pred.shape[0],
+               -1, -step), pred[::step, ::step, 0],
+               pred[::step, ::step, 1])
+    img = save_fig(path, dpi, return_img=return_img)
+    plt.close(plt.gcf())
+
+    return img
+
+
+def save_raster_quiver_plots(preds, output_dir, step=70, scale=None,
+                             imgs=None, dims=None, colour=(0, 255, 0),
+                             thickness=1, video=None):
+    """Saves quiver plots drawn directly onto images.
+
+    Writes images visualizing the direction of optical flow of an image
+    sequence to output_dir. The arrows of each image are computed at once
+    and drawn with a single cv2.polylines call, onto a black canvas or the
+    corresponding frames of the image sequence, without drawing a matplotlib
+    figure.
+
+    Args:
+        preds (list): The optical flow across an image sequence.
+        output_dir (string): The path to the output directory.
+        step (int, optional): The pixel seperation, in the optical flow, of
+            the vectors visualized in the quiver plots. Defaults to 70.
+        scale (float, optional): The length, in optical flow pixels, of the
+            arrow of a vector with a magnitude of 1 pixel. If None, the
+            longest arrow across the image sequence is step pixels long.
+            Defaults to None.
+        imgs (list, optional): The images of the image sequence to draw the
+            arrows onto. If None, a black canvas is used. Defaults to None.
+        dims (tuple, optional): The (width, height) of the saved images. If
+            None, the dimensions of imgs or else of the optical flow are
+            used. Defaults to None.
+        colour (tuple, optional): The BGR colour of the arrows. Defaults to
+            (0, 255, 0).
+        thickness (int, optional): The thickness of the arrows. Defaults to
+            1.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
     """
+    if scale is None:
+        max_mag = max((float(np.nanmax(cart_to_polar(pred[
+                      step // 2::step, step // 2::step])[0], initial=0)) for
+                      pred in preds), default=0)
+        scale = step / max_mag if max_mag > 0 else 0
+    rot = np.array([[np.cos(ARROW_HEAD_ANGLE), -np.sin(ARROW_HEAD_ANGLE)],
+                    [np.sin(ARROW_HEAD_ANGLE), np.cos(ARROW_HEAD_ANGLE)]])
+    shift = 4  # fractional bits of the arrow coordinates
     for i, pred in enumerate(preds):
-        plt.xticks([])
-        plt.yticks([])
-        plt.Axes(plt.figure(frameon=False), [0, 0, 1, 1])
-        plt.axis('off')
-        pred = np.copy(pred)
-        pred[:, :, 1] = pred[:, :, 1] * -1
-        plt.quiver(np.arange(0, pred.shape[1], step), np.arange(pred.shape[0],
-                   -1, -step), pred[::step, ::step, 0],
-                   pred[::step, ::step, 1])
+        hgt, wdh = pred.shape[:2]
+        if imgs is not None:
+            img = imgs[i] if imgs[i].ndim == 3 else cv2.cvtColor(
+                imgs[i], cv2.COLOR_GRAY2BGR)
+            out_dims = (img.shape[1], img.shape[0]) if dims is None else dims
+            canvas = np.array(cv2.resize(img, tuple(out_dims)))
+        else:
+            out_dims = (wdh, hgt) if dims is None else dims
+            canvas = np.zeros((out_dims[1], out_dims[0], 3), np.uint8)
+
+        ys, xs = np.mgrid[step // 2:hgt:step, step // 2:wdh:step]
+        factors = np.array([out_dims[0] / wdh, out_dims[1] / hgt])
+        tails = np.stack([xs, ys], axis=-1).reshape(-1, 2) * factors
+        vecs = np.nan_to_num(np.asarray(pred[step // 2::step, step // 2::step],
+                                        dtype=float)).reshape(-1, 2)
+        vecs *= scale * factors
+        moving = (vecs != 0).any(axis=1)
+        tails, vecs = tails[moving], vecs[moving]
+        tips = tails + vecs
+        heads = -vecs * ARROW_HEAD_LEN
+        arrows = np.stack([tails, tips, tips + heads @ rot.T, tips,
+                           tips + heads @ rot], axis=1)
+        cv2.polylines(canvas, np.round(arrows * 2 ** shift).astype(np.int32),
+                      False, colour, thickness, cv2.LINE_AA, shift)
         path = os.path.join(output_dir, 'Image_{}.png'.format(i))
-        plt.savefig(path, dpi=dpi, bbox_inches=0)
-        plt.close(plt.gcf())
+        cv2.imwrite(path, canvas)
+        if video is not None:
+            video.write(canvas)
 
 
-def gen_base_metrics(data):
+def gen_base_metrics(data, map_dims=None):
     """Generates metrics for the optical flow data of an image sequence.
 
+    The optical flow is consumed one frame at a time (see iter_base_metrics),
+    so only the per-frame statistics and, optionally, downsampled magnitude
+    and direction maps are kept.
+
     Args:
         data (Defaultdict(list)): Contains an image sequence under the key
             'raw_imgs' and the corresponding optical flow under the key
             'preds'.
+        map_dims (tuple, optional): The (width, height) of the magnitude and
+            direction maps to store under the keys 'mags' and 'dirns'. If
+            None, no maps are stored. Defaults to None.
+    """
+    mpp = data['raw_imgs'][0].metadata['mpp']  # convert to um, calib?
+    for metrics in iter_base_metrics(data['preds'], mpp, map_dims):
+        for key, val in metrics.items():
+            data[key].append(val)
+
+
+def iter_base_metrics(preds, mpp=1, map_dims=None):
+    """Generates metrics for optical flow frame by frame.
+
+    Only a single frame of optical flow is processed at a time, so memory is
+    bounded by a single frame when preds is loaded lazily (e.g. with
+    rainbow.util.load_optical_flow).
+
+    Args:
+        preds (iterable): The optical flow across an image sequence.
+        mpp (float, optional): The micrometres per pixel value of the image
+            sequence. Defaults to 1.
+        map_dims (tuple, optional): The (width, height) of the magnitude and
+            direction maps to generate from the optical flow downsampled to
+            map_dims. If None, no maps are generated. Defaults to None.
+
+    Yields:
+        dict: The magnitude and direction statistics of a frame under the keys
+            'mag_stats' and 'dirn_stats' and, if map_dims is not None, the
+            magnitude and direction maps under the keys 'mags' and 'dirns'.
     """
-    for i, pred in enumerate(data['preds']):
-        mag, dirn = cv2.cartToPolar(pred[..., 0].astype(float),
-                                    pred[..., 1].astype(float),
-                                    angleInDegrees=1)
-        data['mags'].append(mag)
-        data['dirns'].append(dirn)
+    for i, pred in enumerate(preds):
+        mag, dirn = cart_to_polar(pred)
         mag[np.isnan(mag)] = 0  # remove NaNs
-        mag *= data['raw_imgs'][0].metadata['mpp']  # convert to um, calib?
-        for key, metric in zip(['mag_stats', 'dirn_stats'], [mag, dirn]):
-            circ = True if key == 'dirn_stats' else False
-            data[key].append(gen_stats(metric, i, circ))
+        mag *= mpp
+        metrics = {'mag_stats': gen_stats(mag, i),
+                   'dirn_stats': gen_stats(dirn, i, circ=True)}
+        if map_dims is not None:
+            mag, dirn = cart_to_polar(cv2.resize(
+                np.asarray(pred, dtype=np.float32), tuple(map_dims),
+                interpolation=cv2.INTER_AREA))
+            mag[np.isnan(mag)] = 0
+            mag *= mpp
+            metrics['mags'], metrics['dirns'] = mag, dirn
+
+        yield metrics
+
+
+def cart_to_polar(pred):
+    """Converts optical flow to magnitudes and directions.
+
+    Args:
+        pred (numpy.ndarray): The optical flow of a frame.
+
+    Returns:
+        tuple: The magnitudes and the directions in degrees of pred as numpy
+            arrays.
+    """
+    return cv2.cartToPolar(pred[..., 0].astype(float),
+                           pred[..., 1].astype(float), angleInDegrees=1)
 
 
 def gen_stats(metric, i, circ=False):
@@ -228,22 +1029,55 @@ def gen_stats(metric, i, circ=False):
     Returns:
         dict: The statistics for the given metric.
     """
+    return gen_batch_stats(np.asarray(metric)[np.newaxis], circ, i)[0]
+
+
+def gen_batch_stats(metrics, circ=False, start=0):
+    """Calculates statistics for a given metric in all frames at once.
+
+    Vectorised equivalent of gen_stats for every frame of an image sequence,
+    producing identical statistics. Circular statistics are derived from the
+    sums of the sines and cosines of each frame, as in scipy.stats.circmean,
+    scipy.stats.circstd and scipy.stats.circvar.
+
+    Args:
+        metrics (numpy.ndarray): The values of the given metric with shape
+            [N, H, W] or [N, M], where N is the number of frames.
+        circ (bool, optional): If true, treats metrics as circular data in
+            degrees. Defaults to False.
+        start (int, optional): The frame number of the first frame.
+            Defaults to 0.
+
+    Returns:
+        list: The statistics for the given metric in each frame.
+    """
+    metrics = np.asarray(metrics)
+    metrics = metrics.reshape(len(metrics), -1)
+    n = metrics.shape[1]
+    minis, maxis = metrics.min(axis=1), metrics.max(axis=1)
     if circ:
-        metric = list(chain.from_iterable(metric.tolist()))
-        mini, maxi = min(metric), max(metric)
-        metric = np.deg2rad(metric)
-        mean, std, var = scipy.stats.circmean(metric), scipy.stats.circstd(
-            metric), scipy.stats.circvar(metric)
-        mean, std, var = np.rad2deg(mean), np.rad2deg(std), np.rad2deg(var)
-        stats = {'frame': i, 'min': mini, 'max': maxi, 'mean': mean,
-                 'std': std, 'var': var}
+        rads = np.deg2rad(metrics)
+        sin_sums, cos_sums = np.sin(rads).sum(axis=1), np.cos(rads).sum(axis=1)
+        del rads
+        means, stds, vars_ = [], [], []
+        # per frame scalar arithmetic, as in scipy, for identical rounding
+        for sin_sum, cos_sum in zip(sin_sums, cos_sums):
+            # resultant length, can go slightly above 1 due to rounding
+            r = np.minimum(((sin_sum / n) ** 2. + (cos_sum / n) ** 2.) ** 0.5,
+                           1.)
+            means.append(np.rad2deg(np.arctan2(sin_sum, cos_sum) % (
+                2.0 * np.pi)))
+            stds.append(np.rad2deg((-2 * np.log(r)) ** 0.5 + 0.0))
+            vars_.append(np.rad2deg(1. - r))
     else:
-        stats = scipy.stats.describe(metric, axis=None)
-        stats = {'frame': i, 'min': stats[1][0],
-                 'max': stats[1][1], 'mean': stats[2],
-                 'std': math.sqrt(stats[3]), 'var': stats[3]}
+        means = metrics.mean(axis=1)
+        vars_ = ((metrics - means[:, np.newaxis]) ** 2).mean(
+            axis=1) * np.true_divide(n, n - 1)
+        stds = np.sqrt(vars_)
 
-    return stats
+    return [{'frame': start + i, 'min': mini, 'max': maxi, 'mean': mean,
+             'std': std, 'var': var} for i, (mini, maxi, mean, std, var) in
+            enumerate(zip(minis, maxis, means, stds, vars_))]
 
 
 def save_stats(stats, csv_path, unit):
@@ -271,11 +1105,15 @@ def save_stats(stats, csv_path, unit):
         warnings.warn(msg, UserWarning)
 
 
-def save_polar_plots(preds, output_dir, dpi=1000, mpp=None):
+def save_polar_plots(preds, output_dir, dpi=1000, mpp=None, max_mag=None,
+                     num_r_bins=DEFAULT_NUM_R_BINS,
+                     num_phi_bins=DEFAULT_NUM_PHI_BINS, video=None,
+                     pool=None):
     """Saves polar plots.
 
     Writes polar plots visualizing the optical flow circular data of an image
-    sequence to output_dir.
+    sequence to output_dir, along with the plotted polar histograms (see
+    save_polar_hists).
 
     Args:
         preds (list): The optical flow across an image sequence.
@@ -284,13 +1122,350 @@ def save_polar_plots(preds, output_dir, dpi=1000, mpp=None):
             Defaults to 1000.
         mpp (float, optional): The micrometres per pixel value of the
             image sequence, if None will use pixel units. Defaults to None.
+        max_mag (float, optional): The upper edge of the last magnitude bin,
+            in the units given by mpp. If None, the maximum magnitude across
+            the image sequence is used. Defaults to None.
+        num_r_bins (int, optional): The number of magnitude bins. Defaults
+            to DEFAULT_NUM_R_BINS.
+        num_phi_bins (int, optional): The number of angle bins. Defaults to
+            DEFAULT_NUM_PHI_BINS.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+        pool (RenderPool, optional): The processes to render the images
+            with. If None, images are rendered in this process. Defaults to
+            None.
+    """
+    hists, r_edges, phi_edges = gen_polar_hists(preds, mpp, max_mag,
+                                                num_r_bins, num_phi_bins)
+    save_polar_hists(hists, r_edges, phi_edges, os.path.join(
+        output_dir, f'{rainbow.POLAR_HISTS_FILENAME}.npz'))
+    plot_polar_hists(hists, r_edges, phi_edges, output_dir, dpi, video=video,
+                     pool=pool)
+
+
+def gen_polar_hists(preds, mpp=None, max_mag=None,
+                    num_r_bins=DEFAULT_NUM_R_BINS,
+                    num_phi_bins=DEFAULT_NUM_PHI_BINS):
+    """Bins the optical flow of an image sequence in polar coordinates.
+
+    The bin edges are shared by all frames: the magnitude bins evenly span
+    [0, max_mag] and the angle bins evenly span [0, 2 pi). Each frame is
+    binned with a single numpy.bincount call. Only a single frame of optical
+    flow is processed at a time (see iter_base_metrics), so if max_mag is
+    None the optical flow is read twice, once to find the maximum magnitude
+    and once to bin it.
+
+    Args:
+        preds (list): The optical flow across an image sequence.
+        mpp (float, optional): The micrometres per pixel value of the
+            image sequence, if None will use pixel units. Defaults to None.
+        max_mag (float, optional): The upper edge of the last magnitude bin,
+            in the units given by mpp. If None, the maximum magnitude across
+            the image sequence is used. Defaults to None.
+        num_r_bins (int, optional): The number of magnitude bins. Defaults
+            to DEFAULT_NUM_R_BINS.
+        num_phi_bins (int, optional): The number of angle bins. Defaults to
+            DEFAULT_NUM_PHI_BINS.
+
+    Returns:
+        tuple: The histograms with shape [N, num_r_bins, num_phi_bins], the
+            magnitude bin edges and the angle bin edges (in radians) as
+            numpy arrays.
     """
     if mpp is None:
         mpp = 1
-    for i, pred in enumerate(preds):
-        x, y = pred[..., 0].flatten() * mpp, pred[..., 1].flatten() * mpp
-        hist = polar(x, y)
-        hist.plot.polar_map(cmap="rainbow")
-        path = os.path.join(output_dir, 'Image_{}.png'.format(i))
-        plt.savefig(path, dpi=dpi, bbox_inches=0)
-        plt.close()
+    # magnitudes are computed as in iter_base_metrics, so that the maximum
+    # magnitude statistic bounds them exactly
+    if max_mag is None:
+        max_mag = 0
+        for pred in preds:
+            max_mag = max(max_mag, float(np.nanmax(cart_to_polar(pred)[0] *
+                                                   mpp, initial=0)))
+    r_edges = np.linspace(0, max_mag if max_mag > 0 else 1, num_r_bins + 1)
+    phi_edges = np.linspace(0, 2 * np.pi, num_phi_bins + 1)
+    hists = []
+    for pred in preds:
+        mag = cart_to_polar(pred)[0].ravel() * mpp
+        x, y = pred[..., 0].ravel(), pred[..., 1].ravel()
+        dirn = np.arctan2(y, x) % (2 * np.pi)
+        valid = mag <= r_edges[-1]  # also drops NaNs
+        # the last bins include their upper edge, as in numpy.histogram
+        r_idxs = np.minimum(np.searchsorted(r_edges, mag[valid], 'right') - 1,
+                            num_r_bins - 1)
+        phi_idxs = np.minimum(np.searchsorted(phi_edges, dirn[valid],
+                                              'right') - 1, num_phi_bins - 1)
+        hists.append(np.bincount(r_idxs * num_phi_bins + phi_idxs, minlength=
+                                 num_r_bins * num_phi_bins).reshape(
+                                     num_r_bins, num_phi_bins))
+
+    hists = np.array(hists).reshape(-1, num_r_bins, num_phi_bins)
+
+    return hists, r_edges, phi_edges
+
+
+def save_polar_hists(hists, r_edges, phi_edges, path):
+    """Saves polar histograms to a .npz file.
+
+    The histograms can be loaded with numpy.load and re-plotted with
+    plot_polar_hists without reloading the optical flow.
+
+    Args:
+        hists (numpy.ndarray): The histograms, see gen_polar_hists.
+        r_edges (numpy.ndarray): The magnitude bin edges.
+        phi_edges (numpy.ndarray): The angle bin edges in radians.
+        path (string): The path of the .npz file to create.
+    """
+    try:
+        np.savez(path, hists=hists, r_edges=r_edges, phi_edges=phi_edges)
+    except OSError as e:
+        msg = f'Could not save polar histograms, reason: {str(e)}.'
+        warnings.warn(msg, UserWarning)
+
+
+def plot_polar_hists(hists, r_edges, phi_edges, output_dir, dpi=1000,
+                     cmap='rainbow', video=None, pool=None):
+    """Plots polar histograms.
+
+    Writes an image per histogram to output_dir. Each process draws a single
+    figure whose bar colours and colour scale are updated for each
+    histogram (see render_polar_hist).
+
+    Args:
+        hists (numpy.ndarray): The histograms, see gen_polar_hists.
+        r_edges (numpy.ndarray): The magnitude bin edges.
+        phi_edges (numpy.ndarray): The angle bin edges in radians.
+        output_dir (string): The path to the output directory.
+        dpi (int, optional): The dots per inch of the saved images. Defaults
+            to 1000.
+        cmap (string, optional): The name of the matplotlib colormap.
+            Defaults to 'rainbow'.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+        pool (RenderPool, optional): The processes to render the images
+            with. If None, images are rendered in this process. Defaults to
+            None.
+    """
+    try:
+        render_frames(render_polar_hist, hists, output_dir, video, pool,
+                      r_edges=r_edges, phi_edges=phi_edges, dpi=dpi,
+                      cmap=cmap)
+    finally:
+        close_polar_figs()
+
+
+def render_polar_hist(hist, path, r_edges, phi_edges, dpi=1000,
+                      cmap='rainbow', return_img=False):
+    """Renders the polar plot of a polar histogram.
+
+    The figure is kept and reused by subsequent calls with the same bin edges
+    and colormap, only updating its bar colours and colour scale.
+
+    Args:
+        hist (numpy.ndarray): The histogram, see gen_polar_hists.
+        path (string): The path of the image to create.
+        r_edges (numpy.ndarray): The magnitude bin edges.
+        phi_edges (numpy.ndarray): The angle bin edges in radians.
+        dpi (int, optional): The dots per inch of the saved image. Defaults
+            to 1000.
+        cmap (string, optional): The name of the matplotlib colormap.
+            Defaults to 'rainbow'.
+        return_img (bool, optional): If True, returns the rendered image.
+            Defaults to False.
+
+    Returns:
+        numpy.ndarray: The rendered image if return_img is True, else None.
+    """
+    key = (r_edges.tobytes(), phi_edges.tobytes(), cmap)
+    if key not in polar_figs:
+        close_polar_figs()
+        cmap = plt.get_cmap(cmap)
+        fig = plt.figure()
+        ax = fig.add_subplot(projection='polar')
+        phis, rs = np.meshgrid(phi_edges[:-1], r_edges[:-1])
+        widths, hgts = np.meshgrid(np.diff(phi_edges), np.diff(r_edges))
+        bars = ax.bar(phis.ravel(), hgts.ravel(), width=widths.ravel(),
+                      bottom=rs.ravel(), align='edge', edgecolor=cmap(0.5),
+                      lw=0.5)
+        ax.set_rmax(r_edges[-1])
+        mappable = plt.cm.ScalarMappable(cmap=cmap)
+        fig.colorbar(mappable, ax=ax)
+        polar_figs[key] = (fig, bars, mappable)
+
+    fig, bars, mappable = polar_figs[key]
+    mappable.set_clim(hist.min(), hist.max())
+    for bar, colour in zip(bars, mappable.to_rgba(hist.ravel())):
+        bar.set_facecolor(colour)
+
+    return save_fig(path, dpi, fig, return_img)
+
+
+def close_polar_figs():
+    """Closes the persistent polar plot figures of this process."""
+    while polar_figs:
+        plt.close(polar_figs.popitem()[1][0])
+
+
+def save_fig(path, dpi, fig=None, return_img=False):
+    """Saves a matplotlib figure as a .png image.
+
+    The figure is rendered once and, if requested, the rendered image is
+    also returned without reading it back from disk.
+
+    Args:
+        path (string): The path of the image to create.
+        dpi (int): The dots per inch of the saved image.
+        fig (matplotlib.figure.Figure, optional): The figure. If None, the
+            current figure is used. Defaults to None.
+        return_img (bool, optional): If True, returns the rendered image.
+            Defaults to False.
+
+    Returns:
+        numpy.ndarray: The rendered image as a BGR image if return_img is
+            True, else None.
+    """
+    fig = plt.gcf() if fig is None else fig
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi, bbox_inches=0)
+    with open(path, 'wb') as f:
+        f.write(buf.getbuffer())
+    if return_img:
+        return cv2.imdecode(np.frombuffer(buf.getbuffer(), np.uint8),
+                            cv2.IMREAD_COLOR)
+
+
+def render_frames(render_frame, frames, output_dir, video=None, pool=None,
+                  **kwargs):
+    """Renders an image per frame of an image sequence.
+
+    Args:
+        render_frame (function): The function rendering a frame, called as
+            render_frame(frame, path, return_img=..., **kwargs).
+        frames (iterable): The frames, e.g. the optical flow across an image
+            sequence.
+        output_dir (string): The path to the output directory.
+        video (rainbow.util.VideoWriter, optional): A video to also write
+            the images to. Defaults to None.
+        pool (RenderPool, optional): The processes to render the images
+            with. If None, images are rendered in this process. Defaults to
+            None.
+        **kwargs: Further keyword arguments for render_frame.
+    """
+    if pool is not None:
+        pool.render(render_frame, frames, output_dir, video, **kwargs)
+        return
+
+    for i, frame in enumerate(frames):
+        img = render_frame(frame, os.path.join(output_dir, f'Image_{i}.png'),
+                           return_img=video is not None, **kwargs)
+        if video is not None:
+            video.write(img)
+
+
+class RenderPool:
+    """Pool of processes rendering the frames of an image sequence.
+
+    Frames are not pickled to the processes, but copied in chunks to a block
+    of shared memory that the processes read them from.
+    """
+    def __init__(self, num_wrkrs):
+        """Initializes class instance and starts the processes.
+
+        Args:
+            num_wrkrs (int): The number of processes.
+        """
+        self.num_wrkrs = num_wrkrs
+        self.executor = ProcessPoolExecutor(num_wrkrs,
+                                            mp_context=get_context('spawn'))
+
+    def render(self, render_frame, frames, output_dir, video=None, **kwargs):
+        """Renders an image per frame of an image sequence.
+
+        See render_frames. Images are written to the video in order.
+
+        Args:
+            render_frame (function): The module level function rendering a
+                frame.
+            frames (iterable): The frames, all with the same shape and data
+                type.
+            output_dir (string): The path to the output directory.
+            video (rainbow.util.VideoWriter, optional): A video to also write
+                the images to. Defaults to None.
+            **kwargs: Further keyword arguments for render_frame.
+        """
+        shm, chunk = None, []
+        try:
+            for i, frame in enumerate(frames):
+                frame = np.asarray(frame)
+                if shm is None:
+                    shape = (RENDER_CHUNK_SIZE * self.num_wrkrs, *frame.shape)
+                    shm = SharedMemory(create=True, size=max(
+                                       frame.nbytes * shape[0], 1))
+                    buf = np.ndarray(shape, frame.dtype, buffer=shm.buf)
+                buf[len(chunk)] = frame
+                chunk.append(i)
+                if len(chunk) == len(buf):
+                    self.render_chunk(render_frame, shm.name, buf, chunk,
+                                      output_dir, video, kwargs)
+                    chunk = []
+            if chunk:
+                self.render_chunk(render_frame, shm.name, buf, chunk,
+                                  output_dir, video, kwargs)
+        finally:
+            if shm is not None:
+                del buf
+                shm.close()
+                shm.unlink()
+
+    def render_chunk(self, render_frame, shm_name, buf, chunk, output_dir,
+                     video, kwargs):
+        """Renders the frames in shared memory and waits for them.
+
+        Args:
+            render_frame (function): The module level function rendering a
+                frame.
+            shm_name (string): The name of the shared memory block.
+            buf (numpy.ndarray): The frames in the shared memory block.
+            chunk (list): The frame numbers of the frames in buf.
+            output_dir (string): The path to the output directory.
+            video (rainbow.util.VideoWriter): A video to also write the images
+                to, or None.
+            kwargs (dict): Further keyword arguments for render_frame.
+        """
+        jobs = [self.executor.submit(
+                render_shared_frame, render_frame, shm_name, buf.shape,
+                buf.dtype.str, j, os.path.join(output_dir, f'Image_{i}.png'),
+                video is not None, kwargs) for j, i in enumerate(chunk)]
+        for job in jobs:
+            img = job.result()
+            if video is not None:
+                video.write(img)
+
+    def shutdown(self):
+        """Shuts down the processes."""
+        self.executor.shutdown()
+
+
+def render_shared_frame(render_frame, shm_name, shape, dtype, idx, path,
+                        return_img, kwargs):
+    """Renders a frame read from shared memory.
+
+    Args:
+        render_frame (function): The function rendering the frame.
+        shm_name (string): The name of the shared memory block.
+        shape (tuple): The shape of the frames in the shared memory block.
+        dtype (string): The data type of the frames.
+        idx (int): The index of the frame in the shared memory block.
+        path (string): The path of the image to create.
+        return_img (bool): If True, returns the rendered image.
+        kwargs (dict): Further keyword arguments for render_frame.
+
+    Returns:
+        numpy.ndarray: The rendered image if return_img is True, else None.
+    """
+    shm = SharedMemory(name=shm_name)
+    try:
+        frame = np.array(np.ndarray(shape, dtype, buffer=shm.buf)[idx])
+    finally:
+        shm.close()
+
+    return render_frame(frame, path, return_img=return_img, **kwargs)
@@ -0,0 +1,212 @@
+import json
+import math
+import os
+import warnings
+
+import cv2
+
+from nd2reader import ND2Reader
+
+from natsort import natsorted
+
+from PIL import Image
+
+from rainbow.util import atomic_output
+
+SEQ_ORDERS = ('path', 'largest')
+NUM_CHANNELS = 3  # loaded images are BGR
+
+
+def index_img_paths(img_paths, nd2_config, cache_path=None):
+    """Indexes the image sequences located at img_paths.
+
+    Only file headers are read: the number of frames and the frame dimensions
+    of each image sequence, including each image sequence stored in a .nd2
+    file, are determined without loading any image. Index entries are cached
+    and reused while the directory or .nd2 file they describe is unchanged.
+
+    Args:
+        img_paths (iterable): Paths to directories containing an image
+            sequence as image files or to .nd2 files.
+        nd2_config (dict): The .nd2 file configuration, see
+            rainbow.util.iter_nd2_imgs.
+        cache_path (string, optional): The path to the index cache file. If
+            None, no cache is used. Defaults to None.
+
+    Returns:
+        list: An index entry per path, as a dict with the keys 'path' and
+            'seqs', a list of the image sequences at path as dicts with the
+            keys 'num_frames' and 'shape' (the dimensions of a loaded
+            frame).
+    """
+    cache = load_index_cache(cache_path) if cache_path is not None else {}
+    index, cache_changed = [], False
+    for img_path in img_paths:
+        img_path = os.path.abspath(img_path)
+        key = get_index_key(img_path, nd2_config)
+        entry = cache.get(img_path)
+        if entry is None or entry['key'] != key:
+            seqs = (index_std_imgs(img_path) if os.path.isdir(img_path) else
+                    index_nd2_imgs(img_path, nd2_config))
+            entry = cache[img_path] = {'key': key, 'seqs': seqs}
+            cache_changed = True
+        index.append({'path': img_path, 'seqs': entry['seqs']})
+
+    if cache_path is not None and cache_changed:
+        save_index_cache(cache, cache_path)
+
+    return index
+
+
+def get_index_key(img_path, nd2_config):
+    """Determines the key validating the index entry of a path.
+
+    The key of a directory changes when files are added to or removed from
+    it, the key of a .nd2 file when it is modified or the .nd2 file
+    configuration changes.
+
+    Args:
+        img_path (string): The path to a directory or .nd2 file.
+        nd2_config (dict): The .nd2 file configuration.
+
+    Returns:
+        list: The key.
+    """
+    stat = os.stat(img_path)
+    if os.path.isdir(img_path):
+        return [stat.st_mtime_ns]
+
+    return [stat.st_size, stat.st_mtime_ns, json.dumps(
+            nd2_config, sort_keys=True, default=str)]
+
+
+def index_std_imgs(input_dir):
+    """Indexes the image sequence in input_dir from file headers.
+
+    Counts the files that can be read as images, see
+    rainbow.util.iter_std_imgs, and reads the dimensions of the first one.
+
+    Args:
+        input_dir (string): The path to the input directory.
+
+    Returns:
+        list: The image sequence, if any, see index_img_paths.
+    """
+    try:
+        files = natsorted(next(os.walk(input_dir))[2])
+    except StopIteration:
+        return []
+
+    files = [os.path.join(input_dir, f) for f in files]
+    files = [f for f in files if cv2.haveImageReader(f)]
+    if len(files) == 0:
+        return []
+    try:
+        with Image.open(files[0]) as img:
+            shape = [img.height, img.width, NUM_CHANNELS]
+    except OSError:
+        shape = list(cv2.imread(files[0]).shape)
+
+    return [{'num_frames': len(files), 'shape': shape}]
+
+
+def index_nd2_imgs(nd2, axs_config):
+    """Indexes the image sequences in a .nd2 file from its metadata.
+
+    Args:
+        nd2 (string): The path to a .nd2 file.
+        axs_config (dict): The .nd2 file configuration, see
+            rainbow.util.iter_nd2_imgs.
+
+    Returns:
+        list: The image sequences, see index_img_paths.
+    """
+    try:
+        with ND2Reader(nd2) as frms:
+            sizes = frms.sizes
+    except Exception as e:
+        msg = f'Could not index \'{nd2}\', reason: {str(e)}.'
+        warnings.warn(msg, UserWarning)
+        return []
+
+    iter_axs = [ax for ax in axs_config['iter_axs'] if ax in sizes]
+    bdl_axs = [ax for ax in axs_config['bdl_axs'] if ax in sizes]
+    if len(iter_axs) == 0 or len(bdl_axs) == 0:
+        return []
+    num_seqs = math.prod(sizes[ax] for ax in iter_axs[:-1])
+
+    return [{'num_frames': sizes[iter_axs[-1]], 'shape': [
+            sizes.get('y', 1), sizes.get('x', 1), NUM_CHANNELS]} for _ in
+            range(num_seqs)]
+
+
+def order_index(index, order='path'):
+    """Orders index entries.
+
+    Args:
+        index (list): The index entries, see index_img_paths.
+        order (string, optional): The order, either 'path' (natural order of
+            the paths) or 'largest' (largest total image sequence size
+            first). Defaults to 'path'.
+
+    Raises:
+        ValueError: If the chosen order is not supported.
+
+    Returns:
+        list: The ordered index entries.
+    """
+    if order == 'path':
+        return natsorted(index, key=lambda entry: entry['path'])
+    elif order == 'largest':
+        return sorted(index, key=lambda entry: -sum(
+                      get_seq_size(seq) for seq in entry['seqs']))
+
+    msg = f'Chosen image sequence order ({order}) not supported.'
+    raise ValueError(msg)
+
+
+def get_seq_size(seq):
+    """Estimates the memory used by a loaded image sequence.
+
+    Args:
+        seq (dict): The image sequence, see index_img_paths.
+
+    Returns:
+        int: The size in bytes.
+    """
+    return seq['num_frames'] * math.prod(seq['shape'])
+
+
+def load_index_cache(cache_path):
+    """Loads the index cache.
+
+    Args:
+        cache_path (string): The path to the index cache file.
+
+    Returns:
+        dict: The cached index entries mapped to their paths, empty if the
+            cache does not exist or cannot be read.
+    """
+    try:
+        with open(os.path.expanduser(cache_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index_cache(cache, cache_path):
+    """Saves the index cache atomically.
+
+    Args:
+        cache (dict): The index entries mapped to their paths.
+        cache_path (string): The path to the index cache file.
+    """
+    cache_path = os.path.expanduser(cache_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        with atomic_output(cache_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f)
+    except OSError as e:
+        msg = f'Could not cache dataset index, reason: {str(e)}.'
+        warnings.warn(msg, UserWarning)
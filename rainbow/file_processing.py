@@ -1,22 +1,60 @@
+import json
+import logging
 import os
-from multiprocessing import Process, Queue
+import time
+import uuid
+import warnings
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
 
-from rainbow import OPTICAL_FLOW_FILENAME
-from rainbow.data_analysis import analyze_data
+from rainbow import MANIFEST_FILENAME, PROFILE_SUMMARY_FILENAME
+from rainbow.data_analysis import (DEFAULT_ANALYSIS_ENGINE, export_report,
+                                   record_stages, run_report, run_stages)
+from rainbow.dataset_index import get_seq_size, index_img_paths, order_index
+from rainbow.manifest import is_flow_current
+from rainbow.optical_flow.flow_cache import get_flow_key
 from rainbow.optical_flow.optical_flow import compute_optical_flow
-from rainbow.util import load_nd2_imgs, load_std_imgs
+from rainbow.profiling import iter_profiled, profile_task, summarize_profiles
+from rainbow.scheduler import DependencyError, TaskGraph
+from rainbow.util import (TMP_PREFIX, atomic_output, get_flow_path,
+                          iter_nd2_imgs, load_std_imgs, prefetch)
+
+from natsort import natsorted
 
 from tqdm import tqdm
 
-SENTINEL = 'STOP'
+DEFAULT_PREFETCH = 1
+DEFAULT_SEQ_ORDER = 'path'
+# analysis stages run by each task of the native engine, see
+# rainbow.data_analysis.ANALYSIS_STAGES
+ANALYSIS_TASK_STAGES = (('stats', 'scatter_plots'), ('flow_imgs',),
+                        ('heatmaps',), ('quiver_plots',), ('polar_plots',))
+
+logger = logging.getLogger(__name__)
 
 
-def process_files(root_dir, config, num_wrkrs, subdirs, overwrite_flow):
+def process_files(root_dir, config, num_wrkrs, subdirs, overwrite_flow,
+                  num_flow_wrkrs=1, profile=False, cprofile_stage=None):
     """Processes files located within root_dir.
 
     Finds valid files (image sequences) within root_dir from which to compute
-    the optical flow from and perform data analysis.
+    the optical flow from and perform data analysis. The image sequences are
+    first indexed from file headers, see
+    rainbow.dataset_index.index_img_paths, so that they can be processed in
+    the order set by config['seq_order'] and progress reported in frames.
+    The work is scheduled as
+    a TaskGraph: the optical flow of each image sequence is computed by a
+    model-bound task, each analysis stage (or the report) of the image
+    sequence is a cpu-bound task depending on it and html export and
+    manifest updates are io-bound tasks, so that the analysis of an image
+    sequence overlaps with the optical flow computation of the next ones.
+    If profile is set, the stages of each image sequence are recorded in its
+    output directory (see rainbow.profiling) and summarized in root_dir.
+    Tasks that fail are reported as they finish and returned once all tasks
+    have finished.
 
     Args:
         root_dir (string): The path to an existing directory containing image
@@ -27,97 +65,342 @@ def process_files(root_dir, config, num_wrkrs, subdirs, overwrite_flow):
             If set to None will use the same number of workers as CPU core
             count.
         subdirs (bool): If True, will look for image sequences in root_dir
-            subfolders instead of top level directory.
+            subfolders, at any depth, instead of top level directory.
         overwrite_flow (bool): If True, will compute optical flow
             even if a flow file already exists for an image sequence.
-    """
-    queue = Queue()
-    if num_wrkrs != 1:
-        wrkrs = initialize_workers(num_wrkrs, config, queue)
+        num_flow_wrkrs (int, optional): The number of workers, each with its
+            own optical flow model instance, to use for parallel optical flow
+            computation. If 1, optical flow is computed by a thread of the
+            current process. Defaults to 1.
+        profile (bool, optional): If True, records the wall time, CPU time
+            and process peak resident set size of each stage. Defaults to
+            False.
+        cprofile_stage (string, optional): The name of a stage (e.g.
+            'inference') to also profile with cProfile if profile is set.
+            Defaults to None.
 
+    Returns:
+        list: The failed tasks (see rainbow.scheduler.Task), including the
+            tasks not run because a task they depend on failed.
+    """
+    cache_cfg = config.get('flow_cache') or {}
+    cache_dir = cache_cfg.get('dir') if cache_cfg.get('enabled') else None
+    cache_size = cache_cfg.get('max_size')
+    flow_encoding, compress_flow = (config.get('flow_encoding', 'float32'),
+                                    config.get('flow_compression', False))
+    if num_wrkrs is None:
+        num_wrkrs = os.cpu_count() if os.cpu_count() is not None else 1
+    max_pending_seqs = config.get('max_pending_seqs') or 2 * num_wrkrs
+    graph = TaskGraph({
+        'model': (partial(ProcessPoolExecutor, num_flow_wrkrs,
+                          mp_context=get_context('spawn')) if
+                  num_flow_wrkrs > 1 else partial(ThreadPoolExecutor, 1)),
+        'cpu': partial(ProcessPoolExecutor, num_wrkrs,
+                       mp_context=get_context('spawn')),
+        'io': partial(ThreadPoolExecutor, 1)})
+
+    dirs = list(find_dirs(root_dir)) if subdirs else [root_dir]
+    index = order_index(index_img_paths(get_img_paths(dirs), config['nd2'],
+                                        config.get('index_cache')),
+                        config.get('seq_order', DEFAULT_SEQ_ORDER))
+    seqs = [seq for entry in index for seq in entry['seqs']]
+    if len(seqs) == 0:
+        print(f'No image sequences found in root directory ({root_dir}).')
+    else:
+        logger.info('Found %d image sequences (%d frames), %.1f MB loaded '
+                    '(%.1f MB for the largest one).', len(seqs),
+                    sum(seq['num_frames'] for seq in seqs),
+                    sum(get_seq_size(seq) for seq in seqs) / 2 ** 20,
+                    max(get_seq_size(seq) for seq in seqs) / 2 ** 20)
+
+    profile = ({'run': uuid.uuid4().hex, 'cprofile_stage': cprofile_stage}
+               if profile else None)
+    start = time.perf_counter()
+    pbar = tqdm(total=sum(seq['num_frames'] for seq in seqs), unit='frame')
+    pending_seqs, output_dirs, failed, cancel = [], [], [], True
     try:
-        dirs = [os.path.join(root_dir, curr_dir) for curr_dir in
-                next(os.walk(root_dir))[1]] if subdirs else [root_dir]
-    except StopIteration:
-        print(f'Root directory ({root_dir}) is empty.')
-
-    pbar = tqdm(total=1)
-    for curr_dir in dirs:
-        try:
-            files = next(os.walk(curr_dir))[2]
-        except StopIteration:
-            files = []
-        img_paths = [curr_dir] + [os.path.join(curr_dir, f) for f in files if
-                                  Path(f).suffix == '.nd2']
-        for img_path in img_paths:
-            imgs = ([load_std_imgs(img_path, config['mpp'])] if
-                    os.path.isdir(img_path) else load_nd2_imgs(img_path,
-                    config['nd2'], config['mpp']))
-            if len(imgs[0]) == 0:
+        # Load the next image sequences in the background while computing
+        # the optical flow of the current one.
+        for img_seq, load_session in prefetch(
+                iter_profiled(iter_img_seqs([entry['path'] for entry in
+                                             index], config), 'load',
+                              profile),
+                config.get('prefetch', DEFAULT_PREFETCH)):
+            if len(img_seq) < 2:
+                pbar.update(len(img_seq))
                 continue
+            output_dir = get_output_dir(img_seq, config)
+            model_name = config['opt_flow_model']
+            flow_key = get_flow_key(img_seq, model_name, config[model_name])
+            flow = None
+            if not skip_opt_flow(output_dir, overwrite_flow, flow_key):
+                flow = add_task(graph, output_dir, compute_optical_flow,
+                                img_seq, output_dir, model_name,
+                                config[model_name], resource='model',
+                                overwrite_flow=overwrite_flow,
+                                cache_dir=cache_dir, cache_size=cache_size,
+                                flow_encoding=flow_encoding,
+                                compress_flow=compress_flow,
+                                flow_key=flow_key, profile=profile)
+            pending_seqs.append((len(img_seq), [flow] + add_analysis_tasks(
+                graph, output_dir, config, flow, profile), output_dir,
+                load_session))
+            output_dirs.append(output_dir)
+            # Limit the number of loaded image sequences awaiting a worker and
+            # of image sequences awaiting analysis, so that optical flow
+            # computation does not run ahead of the analysis workers.
+            while (graph.num_pending('model') >= 2 * num_flow_wrkrs or
+                   len(pending_seqs) >= max_pending_seqs):
+                graph.wait(FIRST_COMPLETED)
+                pending_seqs = finish_seqs(pending_seqs, pbar, failed)
+
+        while len(pending_seqs) != 0:
+            graph.wait(FIRST_COMPLETED)
+            pending_seqs = finish_seqs(pending_seqs, pbar, failed)
+        graph.wait()
+        cancel = False
+    finally:
+        # cancel tasks that have not started if interrupted
+        graph.shutdown(cancel)
+        pbar.close()
+
+    if profile is not None:
+        save_profile_summary(root_dir, output_dirs, profile['run'],
+                             time.perf_counter() - start)
+
+    return failed
+
+
+def finish_seqs(pending_seqs, pbar, failed=None):
+    """Counts the frames of finished image sequences in a progress bar.
+
+    The loading of each finished image sequence is then saved to the
+    profile of its output directory, if profiled, and its failed tasks are
+    appended to failed.
+
+    Args:
+        pending_seqs (list): The image sequences with unfinished tasks, as
+            tuples of their number of frames, their tasks, their output
+            directory and the rainbow.profiling.ProfileSession of their
+            loading (or None).
+        pbar (tqdm.tqdm): The progress bar.
+        failed (list, optional): The failed tasks to append those of the
+            finished image sequences to. If None, they are not collected.
+            Defaults to None.
 
-            pbar.total += len(imgs)
-            pbar.refresh()
-            for img_seq in imgs:
-                if len(img_seq) < 2:
-                    pbar.update()
-                    continue
-                output_dir = get_output_dir(img_seq, config)
-                if not skip_opt_flow(output_dir, overwrite_flow):
-                    compute_optical_flow(img_seq, output_dir, config[
-                        'opt_flow_model'], config[config['opt_flow_model']],
-                        overwrite_flow=overwrite_flow)
-
-                queue.put(output_dir)
-                if num_wrkrs == 1:
-                    queue.put(SENTINEL)
-                    analyze_data(queue, config)
-                    queue.get()
-
-                pbar.update()
-
-        if not subdirs:
-            break
-
-    if num_wrkrs != 1:
-        queue.put(SENTINEL)
-        for wrkr in wrkrs:
-            wrkr.join()
-        pbar.update()
+    Returns:
+        list: The image sequences that still have unfinished tasks.
+    """
+    remaining = []
+    for num_frames, tasks, output_dir, load_session in pending_seqs:
+        if all(task is None or task.done for task in tasks):
+            pbar.update(num_frames)
+            if failed is not None:
+                failed += [task for task in tasks if task is not None and
+                           task.error is not None]
+            if load_session is not None and os.path.isdir(output_dir):
+                load_session.save(output_dir)
+        else:
+            remaining.append((num_frames, tasks, output_dir, load_session))
+
+    return remaining
+
+
+def add_analysis_tasks(graph, output_dir, config, flow=None, profile=None):
+    """Adds the data analysis tasks of an output directory to a TaskGraph.
+
+    With the native analysis engine, each group of ANALYSIS_TASK_STAGES is a
+    cpu-bound task, whose completed stages are then recorded in the manifest
+    of output_dir by an io-bound task. With the notebook engine, the report is
+    a cpu-bound task and, if config['background_html_export'] is set, its
+    html export an io-bound task.
+
+    Args:
+        graph (rainbow.scheduler.TaskGraph): The task graph.
+        output_dir (string): The path to an output directory that contains,
+            or will contain, optical flow.
+        config (dict): The loaded .yaml configuration.
+        flow (rainbow.scheduler.Task, optional): The task computing the
+            optical flow of output_dir, if any. Defaults to None.
+        profile (dict, optional): The profiled run, see
+            rainbow.profiling.profile_task. If None, the tasks are not
+            profiled. Defaults to None.
+
+    Raises:
+        ValueError: If the chosen analysis engine is not supported.
+
+    Returns:
+        list: The added tasks.
+    """
+    engine = config.get('analysis_engine', DEFAULT_ANALYSIS_ENGINE)
+    tasks = []
+    if engine == 'native':
+        for stages in ANALYSIS_TASK_STAGES:
+            tasks.append(add_task(graph, output_dir, run_stages, output_dir,
+                                  config, stages, deps=[flow],
+                                  profile=profile))
+            tasks.append(add_task(graph, output_dir, record_stages,
+                                  output_dir, deps=[tasks[-1]],
+                                  resource='io', with_results=True,
+                                  profile=profile))
+    elif engine == 'notebook':
+        html_task = config.get('background_html_export', False)
+        tasks.append(add_task(graph, output_dir, run_report,
+                              output_dir, config, not html_task,
+                              deps=[flow], profile=profile))
+        if html_task:
+            tasks.append(add_task(graph, output_dir, export_report,
+                                  deps=[tasks[-1]], resource='io',
+                                  with_results=True, profile=profile))
     else:
-        pbar.update()
+        msg = f'Chosen analysis engine ({engine}) not supported.'
+        raise ValueError(msg)
+
+    return tasks
 
-    pbar.close()
 
+def add_task(graph, output_dir, fn, *args, profile=None, **kwargs):
+    """Adds a task, whose failure is reported, to a TaskGraph.
 
-def initialize_workers(num_wrkrs, config, queue):
-    """Initializes workers.
+    Args:
+        graph (rainbow.scheduler.TaskGraph): The task graph.
+        output_dir (string): The path to the output directory the task
+            belongs to.
+        fn (function): The function to call.
+        *args: The positional arguments of fn.
+        profile (dict, optional): The profiled run, see
+            rainbow.profiling.profile_task. If given, the stages of the task
+            are recorded in the profile of output_dir. Defaults to None.
+        **kwargs: The keyword arguments of TaskGraph.add and fn.
+
+    Returns:
+        rainbow.scheduler.Task: The task.
+    """
+    name = f'{fn.__name__} (\'{output_dir}\')'
+    if profile is not None:
+        fn, args = profile_task, (fn, output_dir, profile) + args
 
-    Creates and starts workers (subprocesses) that will perfrom data analysis.
+    return graph.add(fn, *args, callback=report_failure, name=name,
+                     **kwargs)
+
+
+def report_failure(task):
+    """Warns if a task failed, unless a task it depends on failed.
 
     Args:
-        num_wrkrs (int): The number of workers to create. If set to None will
-        create the same number of workers as CPU core count.
-        config (string): The path to a .yaml configuration file.
-        queue (multiprocessing.Queue): The queue that will be used to
-            communicate with the workers.
+        task (rainbow.scheduler.Task): The finished task.
+    """
+    if task.error is not None and not isinstance(task.error,
+                                                 DependencyError):
+        msg = f'Task {task.name} failed, reason: {str(task.error)}.'
+        warnings.warn(msg, UserWarning)
+
+
+def save_profile_summary(root_dir, output_dirs, run, wall_time):
+    """Saves and prints the summary of a profiled run.
+
+    The summary is saved as a .json file in root_dir.
+
+    Args:
+        root_dir (string): The path to the root directory of the run.
+        output_dirs (list): The paths to the output directories of the run.
+        run (string): The identifier of the run.
+        wall_time (float): The wall time of the run in seconds.
+    """
+    stages = summarize_profiles(output_dirs, run)
+    path = os.path.join(root_dir, f'{PROFILE_SUMMARY_FILENAME}.json')
+    with atomic_output(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({'run': run, 'wall_time': wall_time, 'output_dirs':
+                       output_dirs, 'stages': stages}, f, indent=4)
+
+    print(f'{"Stage":<24}{"Count":>8}{"Wall (s)":>12}{"Max wall (s)":>14}'
+          f'{"CPU (s)":>12}{"Process peak RSS (MB)":>23}')
+    for stage, summary in sorted(stages.items(), key=lambda item: -item[1][
+                                 'wall_time']):
+        peak_rss = summary['process_peak_rss']
+        print(f'{stage:<24}{summary["count"]:>8}'
+              f'{summary["wall_time"]:>12.2f}'
+              f'{summary["max_wall_time"]:>14.2f}'
+              f'{summary["cpu_time"]:>12.2f}'
+              f'{peak_rss if peak_rss is not None else float("nan"):>23.1f}')
+    print(f'Run wall time: {wall_time:.2f} s, profile summary saved to '
+          f'\'{path}\'.')
+
+
+def find_dirs(root_dir):
+    """Finds the subdirectories of root_dir, at any depth.
+
+    Output directories (containing optical flow or a manifest), hidden
+    directories and temporary directories are skipped along with their
+    subdirectories.
+
+    Args:
+        root_dir (string): The path to the root directory.
+
+    Yields:
+        string: The path to a subdirectory.
+    """
+    for curr_dir, subdirs, files in os.walk(root_dir):
+        subdirs[:] = natsorted(
+            d for d in subdirs if not d.startswith(('.', TMP_PREFIX)) and
+            not is_output_dir(os.path.join(curr_dir, d)))
+        if curr_dir != root_dir:
+            yield curr_dir
+
+
+def is_output_dir(path):
+    """Determines whether a directory is an output directory.
+
+    Args:
+        path (string): The path to a directory.
 
     Returns:
-        list: A list of initalized workers as multiprocessing.Process objects.
+        bool: True if the directory contains optical flow or a manifest.
     """
-    if num_wrkrs is None:
-        num_wrkrs = os.cpu_count() if os.cpu_count() is not None else 1
+    return any(os.path.isfile(f) for f in (get_flow_path(path), os.path.join(
+               path, f'{MANIFEST_FILENAME}.json')))
 
-    wrkrs = []
-    for i in range(0, num_wrkrs):
-        wrkr = Process(target=analyze_data, args=(queue, config))
-        wrkr.daemon = True
-        wrkrs.append(wrkr)
 
-    for wrkr in wrkrs:
-        wrkr.start()
+def get_img_paths(dirs):
+    """Finds the paths of potential image sequences.
 
-    return wrkrs
+    Args:
+        dirs (list): A list of paths to directories to search.
+
+    Yields:
+        string: The path to a directory, which may contain an image sequence
+            as image files, or to a .nd2 file within that directory.
+    """
+    for curr_dir in dirs:
+        try:
+            files = next(os.walk(curr_dir))[2]
+        except StopIteration:
+            files = []
+        yield curr_dir
+        yield from (os.path.join(curr_dir, f) for f in files if
+                    Path(f).suffix == '.nd2')
+
+
+def iter_img_seqs(img_paths, config):
+    """Lazily loads the image sequences located at img_paths.
+
+    Image sequences are loaded one at a time, including those stored
+    together in a .nd2 file. Empty image sequences are skipped.
+
+    Args:
+        img_paths (iterable): Paths to directories containing an image
+            sequence as image files or to .nd2 files.
+        config (dict): The loaded .yaml configuration.
+
+    Yields:
+        list: An image sequence.
+    """
+    for img_path in img_paths:
+        img_seqs = ([load_std_imgs(img_path, config['mpp'])] if os.path.isdir(
+                    img_path) else iter_nd2_imgs(img_path, config['nd2'],
+                                                 config['mpp']))
+        yield from (img_seq for img_seq in img_seqs if len(img_seq) != 0)
 
 
 def get_output_dir(imgs, config):
@@ -145,19 +428,27 @@ def get_output_dir(imgs, config):
     return output_dir
 
 
-def skip_opt_flow(output_dir, overwrite_flow):
+def skip_opt_flow(output_dir, overwrite_flow, flow_key=None):
     """Determines whether optical flow computation should be skipped.
 
-    Skips computation iff an optical flow file already exists in output_dir
-    and optical flow is not set to be overwritten.
+    Skips computation iff an optical flow file already exists in output_dir,
+    is up to date (if flow_key is given) and optical flow is not set to be
+    overwritten.
 
     Args:
         output_dir (string): The path to an existing output directory.
         overwrite_flow (bool): If True, will ignore optical flow file if
             already existing in output_dir.
+        flow_key (string, optional): The key of the optical flow of the image
+            sequence, see rainbow.optical_flow.flow_cache.get_flow_key. If
+            None, an existing optical flow file is assumed up to date.
+            Defaults to None.
 
     Returns:
         bool: Whether optical flow computation should be skipped.
     """
-    return True if not overwrite_flow and (Path(output_dir) / (
-        OPTICAL_FLOW_FILENAME)).is_file() else False
+    if overwrite_flow:
+        return False
+
+    return (is_flow_current(output_dir, flow_key) if flow_key is not None
+            else os.path.isfile(get_flow_path(output_dir)))
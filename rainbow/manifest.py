@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+
+import rainbow
+from rainbow.util import atomic_output, get_flow_path
+
+
+def get_fingerprint(*inputs, paths=()):
+    """Determines the fingerprint of the inputs of a stage.
+
+    The fingerprint is a hash of the rainbow version, the given inputs (e.g.
+    configuration values) and the names, sizes and modification times of the
+    files at the given paths.
+
+    Args:
+        *inputs: JSON serializable inputs of the stage.
+        paths (iterable, optional): The paths to files or directories read by
+            the stage. Defaults to ().
+
+    Returns:
+        string: The fingerprint.
+    """
+    sha = hashlib.sha256(rainbow.__version__.encode())
+    sha.update(json.dumps(inputs, sort_keys=True, default=str).encode())
+    for path in paths:
+        files = ([(root, f) for root, _, files in sorted(os.walk(path)) for
+                 f in sorted(files)] if os.path.isdir(path) else
+                 [os.path.split(path)])
+        for root, f in files:
+            try:
+                stat = os.stat(os.path.join(root, f))
+                sha.update(f'{f}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+            except OSError:
+                sha.update(f'{f}:missing'.encode())
+
+    return sha.hexdigest()
+
+
+class Manifest:
+    """Record of the stages completed in an output directory.
+
+    For each stage (optical flow, statistics, each family of images, report,
+    etc.), the fingerprint of its inputs and the paths of its outputs,
+    relative to the output directory, are stored in a .json file in the
+    output directory. A stage whose fingerprint is unchanged and whose
+    outputs still exist does not need to be run again.
+    """
+    def __init__(self, output_dir):
+        """Initializes class instance and loads the recorded stages.
+
+        Args:
+            output_dir (string): The path to the output directory.
+        """
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir,
+                                 f'{rainbow.MANIFEST_FILENAME}.json')
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except (OSError, ValueError):
+            self.stages = {}
+
+    def is_current(self, stage, fingerprint):
+        """Determines whether a stage is up to date.
+
+        Args:
+            stage (string): The name of the stage.
+            fingerprint (string): The fingerprint of the current inputs of
+                the stage.
+
+        Returns:
+            bool: True if the stage was completed with the same fingerprint
+                and its outputs still exist.
+        """
+        record = self.stages.get(stage)
+        if record is None or record['fingerprint'] != fingerprint:
+            return False
+
+        return all(os.path.exists(os.path.join(self.output_dir, output)) for
+                   output in record['outputs'])
+
+    def record(self, stage, fingerprint, outputs):
+        """Records a completed stage and saves the manifest atomically.
+
+        Args:
+            stage (string): The name of the stage.
+            fingerprint (string): The fingerprint of the inputs of the stage.
+            outputs (iterable): The paths of the outputs of the stage,
+                relative to the output directory.
+        """
+        self.stages[stage] = {'fingerprint': fingerprint,
+                              'outputs': list(outputs)}
+        with atomic_output(self.path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.stages, f, indent=4, sort_keys=True)
+
+
+def is_flow_current(output_dir, flow_key):
+    """Determines whether the optical flow in output_dir is up to date.
+
+    Output directories without a recorded optical flow stage (written by
+    earlier versions) are considered up to date if they contain optical
+    flow.
+
+    Args:
+        output_dir (string): The path to the output directory.
+        flow_key (string): The key of the optical flow of the image sequence,
+            see rainbow.optical_flow.flow_cache.get_flow_key.
+
+    Returns:
+        bool: Whether the optical flow is up to date.
+    """
+    if not os.path.isfile(get_flow_path(output_dir)):
+        return False
+    manifest = Manifest(output_dir)
+
+    return ('flow' not in manifest.stages or
+            manifest.is_current('flow', flow_key))
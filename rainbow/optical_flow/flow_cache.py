@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+CACHE_FILE_EXT = '.npy'
+# model config keys that do not affect the computed optical flow (the device
+# is kept in the key as cpu and gpu kernels give slightly different flow)
+IGNORED_CFG_KEYS = ('batch_size', 'engine', 'num_threads')
+
+
+def get_flow_key(imgs, model_name, model_config):
+    """Determines the cache key of the optical flow of an image sequence.
+
+    The key is a hash of the image sequence pixel data together with the
+    optical flow model name, checkpoint and config, so it does not depend on
+    where the image sequence is stored.
+
+    Args:
+        imgs (list): A list of images.
+        model_name (string): The name of the optical flow model.
+        model_config (dict): The configuration of the optical flow model.
+
+    Returns:
+        string: The cache key.
+    """
+    sha = hashlib.sha256()
+    for img in imgs:
+        img = np.ascontiguousarray(img)
+        sha.update(f'{img.shape}{img.dtype}'.encode())
+        sha.update(img.data)
+
+    cfg = {k: v for k, v in model_config.items() if k not in
+           IGNORED_CFG_KEYS}
+    ckpt = cfg.get('model')
+    if isinstance(ckpt, str) and os.path.isfile(ckpt):
+        stat = os.stat(ckpt)
+        cfg['model'] = [os.path.abspath(ckpt), stat.st_size, stat.st_mtime]
+    sha.update(model_name.encode())
+    sha.update(json.dumps(cfg, sort_keys=True, default=str).encode())
+
+    return sha.hexdigest()
+
+
+def load_cached_flow(cache_dir, key):
+    """Loads optical flow predictions from the cache.
+
+    Marks the cached optical flow as recently used if found.
+
+    Args:
+        cache_dir (string): The path to the cache directory.
+        key (string): The cache key of the optical flow.
+
+    Returns:
+        list: A list of optical flow predictions as numpy arrays, or None if
+            the optical flow is not cached.
+    """
+    path = os.path.join(os.path.expanduser(cache_dir), key + CACHE_FILE_EXT)
+    try:
+        preds = list(np.load(path))
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+
+    return preds
+
+
+def save_cached_flow(preds, cache_dir, key, max_size=None):
+    """Saves optical flow predictions to the cache.
+
+    The file is written atomically. Least recently used cached optical flow
+    is then evicted until the cache is no larger than max_size.
+
+    Args:
+        preds (list): A list of optical flow predictions as numpy arrays.
+        cache_dir (string): The path to the cache directory.
+        key (string): The cache key of the optical flow.
+        max_size (float, optional): The maximum size of the cache in MB. If
+            None, the cache size is unlimited. Defaults to None.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.array(preds), allow_pickle=False)
+            os.replace(tmp_path, os.path.join(cache_dir, key +
+                                              CACHE_FILE_EXT))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except OSError as e:
+        msg = f'Could not cache optical flow, reason: {str(e)}.'
+        warnings.warn(msg, UserWarning)
+        return
+
+    if max_size is not None:
+        evict_cached_flow(cache_dir, max_size)
+
+
+def evict_cached_flow(cache_dir, max_size):
+    """Evicts least recently used optical flow from the cache.
+
+    Args:
+        cache_dir (string): The path to the cache directory.
+        max_size (float): The maximum size of the cache in MB.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(CACHE_FILE_EXT):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(entry[1] for entry in entries)
+    for _, entry_size, path in sorted(entries):
+        if size <= max_size * 2 ** 20:
+            break
+        try:
+            os.remove(path)
+            size -= entry_size
+        except OSError:
+            pass
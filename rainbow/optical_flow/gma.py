@@ -1,15 +1,84 @@
+import logging
 import os
 import sys
 import urllib
 import warnings
 from argparse import Namespace
+from itertools import product
 
 import imutils
 
 from rainbow.optical_flow.base_model import BaseModel
+from rainbow.profiling import profile_stage
 
 MIN_DIMS = (284, 121)
 CHECKPOINTS_BASE_URL = 'https://github.com/AlphonsG/GMA/raw/main/checkpoints/'
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_MAX_BATCH_MEM = 4096  # MB
+DEFAULT_ENGINE = 'pairwise'
+DEFAULT_ITERS = 12
+DEFAULT_CONV_THRESH = 0  # pixels, 0 disables early stopping
+DEFAULT_TILE_SIZE = (512, 512)
+DEFAULT_TILE_OVERLAP = 64
+
+logger = logging.getLogger(__name__)
+
+
+def est_pair_mem(hgt, wdh, num_heads=1):
+    """Estimates the memory needed to compute the optical flow of an image
+    pair.
+
+    The estimate is dominated by the all-pairs correlation pyramid and the
+    global motion aggregation attention matrix, which both grow
+    quadratically with the number of 1/8 resolution feature map positions.
+
+    Args:
+        hgt (int): The (padded) height of the images.
+        wdh (int): The (padded) width of the images.
+        num_heads (int, optional): The number of attention heads.
+            Defaults to 1.
+
+    Returns:
+        int: The estimated memory in bytes.
+    """
+    num_pos = (hgt // 8) * (wdh // 8)
+    corr_mem = num_pos * num_pos * (1 + 1 / 4 + 1 / 16 + 1 / 64)
+    att_mem = num_pos * num_pos * num_heads
+    feat_mem = num_pos * (2 * 256 + 256 + 64 * 9) + 2 * 3 * hgt * wdh
+
+    return int(4 * (corr_mem + att_mem + feat_mem))
+
+
+def get_tile_origins(dims, tile_dims, overlap):
+    """Determines the positions of overlapping tiles covering an image.
+
+    Tiles are spaced tile_dims - overlap apart, with the last tile along each
+    axis aligned to the end of the image.
+
+    Args:
+        dims (tuple): The height and width of the image.
+        tile_dims (tuple): The height and width of the tiles.
+        overlap (int): The minimum overlap in pixels between adjacent tiles.
+
+    Raises:
+        ValueError: The overlap is not smaller than the tile dimensions.
+
+    Returns:
+        list: A list of (y, x) top left corners of the tiles.
+    """
+    starts = []
+    for dim, tile_dim in zip(dims, tile_dims):
+        if not 0 <= overlap < tile_dim:
+            msg = (f'Tile overlap ({overlap}) must be smaller than tile '
+                   f'dimensions ({tile_dims}).')
+            raise ValueError(msg)
+        axis_starts = list(range(0, max(dim - tile_dim, 0) + 1,
+                                 tile_dim - overlap))
+        if axis_starts[-1] + tile_dim < dim:
+            axis_starts.append(dim - tile_dim)
+        starts.append(axis_starts)
+
+    return list(product(*starts))
 
 
 class GMA(BaseModel):
@@ -23,11 +92,18 @@ class GMA(BaseModel):
         gma_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)),
                                'third_party', 'gma', 'core')
         sys.path.insert(1, gma_dir)
-        from network import RAFTGMA
-        from utils.utils import InputPadder
+        from corr import CorrBlock
+        from network import RAFTGMA, autocast
+        from utils.utils import InputPadder, coords_grid, upflow8
         import torch
+        self.CorrBlock = CorrBlock
         self.InputPadder = InputPadder
+        self.autocast = autocast
+        self.coords_grid = coords_grid
+        self.upflow8 = upflow8
         self.torch = torch
+        if model_cfg.get('num_threads'):
+            self.torch.set_num_threads(model_cfg['num_threads'])
         args = Namespace(**model_cfg)
         model = self.torch.nn.DataParallel(RAFTGMA(args))
 
@@ -69,29 +145,335 @@ class GMA(BaseModel):
 
     def predict(self, imgs):
         """See base class."""
-        imgs = imgs.copy()
-        # Resize images to minimum dimensions, if necessary.
-        for i, img in enumerate(imgs):
-            for j, kv in zip([0, 1], [{'height': MIN_DIMS[0]},
-                                      {'width': MIN_DIMS[1]}]):
-                if img.shape[j] < MIN_DIMS[j]:
-                    img = imutils.resize(img, **kv)
-            imgs[i] = img
-
-        imgs = [self.torch.from_numpy(img).permute(2, 0, 1).float()[None].to(
-                self.model_cfg['device']) for img in imgs]
-        imgs = self.get_img_pairs(imgs)
-
-        # Pad images, if necessary.
-        padder = self.InputPadder(imgs[0][0].shape)
-        imgs = [(padder.pad(img1, img2)) for img1, img2 in imgs]
-
-        preds = []
+        with profile_stage('resize_pad', frames=len(imgs)):
+            imgs = imgs.copy()
+            # Resize images to minimum dimensions, if necessary.
+            for i, img in enumerate(imgs):
+                for j, kv in zip([0, 1], [{'height': MIN_DIMS[0]},
+                                          {'width': MIN_DIMS[1]}]):
+                    if img.shape[j] < MIN_DIMS[j]:
+                        img = imutils.resize(img, **kv)
+                imgs[i] = img
+
+            imgs = [self.torch.from_numpy(img).permute(2, 0, 1).float()[
+                    None].to(self.model_cfg['device']) for img in imgs]
+
+            # Pad images, if necessary.
+            padder = self.InputPadder(imgs[0].shape)
+            imgs = padder.pad(*imgs)
+
+        engine = self.model_cfg.get('engine', DEFAULT_ENGINE)
+        if engine == 'pairwise':
+            engine = self.predict_pairwise
+        elif engine == 'cached':
+            engine = self.predict_cached
+        else:
+            msg = f'Chosen GMA inference engine ({engine}) not supported.'
+            raise ValueError(msg)
+
+        self.num_iters = []
+        if self.model_cfg.get('tiled', False):
+            tile_dims = self.get_tile_dims(*imgs[0].shape[-2:])
+            flows = self.predict_tiled(imgs, engine, tile_dims)
+        else:
+            flows = engine(imgs)
+        logger.info('Refinement iterations per image pair: %s',
+                    self.num_iters)
+
+        return [flow.permute(1, 2, 0).cpu().numpy() for flow in flows]
+
+    def predict_tiled(self, imgs, engine, tile_dims):
+        """Computes the optical flow of image pairs tile by tile.
+
+        Runs the inference engine on overlapping tiles of the images and
+        blends the optical flow of overlapping tiles with weights that fall
+        off linearly towards the tile edges.
+
+        Args:
+            imgs (list): A list of padded images as tensors of dimension
+                [1, 3, H, W].
+            engine (function): The inference engine to run on each tile.
+            tile_dims (tuple): The height and width of the tiles.
+
+        Returns:
+            list: A list of optical flow predictions as tensors of dimension
+                [2, H, W].
+        """
+        overlap = self.model_cfg.get('tile_overlap', DEFAULT_TILE_OVERLAP)
+        hgt, wdh = imgs[0].shape[-2:]
+        tile_hgt, tile_wdh = tile_dims
+        ramps = [self.torch.minimum(self.torch.arange(1, dim + 1),
+                                    self.torch.arange(dim, 0, -1)).clamp(
+                 max=overlap + 1).float() for dim in tile_dims]
+        tile_weight = (ramps[0][:, None] * ramps[1][None]).to(imgs[0].device)
+        flows = self.torch.zeros(len(imgs) - 1, 2, hgt, wdh,
+                                 device=imgs[0].device)
+        weights = self.torch.zeros(hgt, wdh, device=imgs[0].device)
+        tile_num_iters = []
+        for y, x in get_tile_origins((hgt, wdh), tile_dims, overlap):
+            win = (..., slice(y, y + tile_hgt), slice(x, x + tile_wdh))
+            self.num_iters = []
+            tile_flows = engine([img[win] for img in imgs])
+            flows[win] += self.torch.stack(tile_flows) * tile_weight
+            weights[win] += tile_weight
+            tile_num_iters.append(self.num_iters)
+        self.num_iters = [max(num_iters) for num_iters in zip(
+                          *tile_num_iters)]
+
+        return list(flows / weights)
+
+    def get_tile_dims(self, hgt, wdh):
+        """Determines the dimensions of the tiles used for tiled inference.
+
+        Uses the tile size set in the model config, rounded to multiples of 8
+        and limited to the minimum model input and image dimensions. Tiles
+        are then halved along their largest side until the estimated memory
+        of computing the optical flow of a tile pair is within the configured
+        memory budget.
+
+        Args:
+            hgt (int): The (padded) height of the images.
+            wdh (int): The (padded) width of the images.
+
+        Raises:
+            ValueError: The smallest possible tile does not fit within the
+                memory budget.
+
+        Returns:
+            tuple: The height and width of the tiles.
+        """
+        min_dims = [-(-dim // 8) * 8 for dim in MIN_DIMS]
+        tile_dims = [min(max(tile_dim // 8 * 8, min_dim), dim) for tile_dim,
+                     min_dim, dim in zip(self.model_cfg.get(
+                         'tile_size', DEFAULT_TILE_SIZE), min_dims,
+                         (hgt, wdh))]
+        max_mem = self.model_cfg.get('max_batch_mem', DEFAULT_MAX_BATCH_MEM)
+        while est_pair_mem(*tile_dims, self.model_cfg['num_heads']) > (
+                max_mem * 2 ** 20):
+            if tile_dims == min_dims:
+                msg = (f'Smallest tile ({tile_dims}) does not fit within the '
+                       f'memory budget ({max_mem} MB).')
+                raise ValueError(msg)
+            i = 0 if tile_dims[0] - min_dims[0] >= tile_dims[1] - min_dims[
+                1] else 1
+            tile_dims[i] = max(tile_dims[i] // 16 * 8, min_dims[i])
+
+        return tuple(tile_dims)
+
+    def predict_pairwise(self, imgs):
+        """Computes the optical flow of image pairs with full forward passes.
+
+        Image pairs are computed one at a time if warm starting is enabled.
+        Early stopping is not supported by this engine.
+
+        Args:
+            imgs (list): A list of padded images as tensors of dimension
+                [1, 3, H, W].
+
+        Returns:
+            list: A list of optical flow predictions as tensors of dimension
+                [2, H, W].
+        """
+        if self.model_cfg.get('conv_thresh', DEFAULT_CONV_THRESH) > 0:
+            msg = ('Early stopping (conv_thresh) is only supported by the '
+                   'cached GMA inference engine and will be ignored.')
+            warnings.warn(msg, UserWarning)
+        iters = self.model_cfg.get('iters', DEFAULT_ITERS)
+        warm_start = self.model_cfg.get('warm_start', False)
+        img_pairs = self.get_img_pairs(imgs)
+        batch_size = (1 if warm_start else
+                      self.get_batch_size(*imgs[0].shape[-2:]))
+        flows, flow_init = [], None
         with self.torch.no_grad():
-            for img1, img2 in imgs:
-                with warnings.catch_warnings():
+            for i in range(0, len(img_pairs), batch_size):
+                img1, img2 = (self.torch.cat(batch) for batch in zip(
+                              *img_pairs[i:i + batch_size]))
+                with warnings.catch_warnings(), profile_stage(
+                        'inference', pairs=len(img1)):
                     warnings.filterwarnings('ignore', category=UserWarning)
-                    _, flow = self.model(img1, img2, iters=12, test_mode=True)
-                preds.append(flow[0].permute(1, 2, 0).cpu().numpy())
+                    flow_low, flow = self.model(img1, img2, iters=iters,
+                                                flow_init=flow_init,
+                                                test_mode=True)
+                if warm_start:
+                    flow_init = flow_low
+                flows.extend(flow)
+                self.num_iters.extend([iters] * len(flow))
+
+        return flows
+
+    def predict_cached(self, imgs):
+        """Computes the optical flow of image pairs with cached encodings.
+
+        Every image is passed through the feature encoder once and its
+        feature map is reused as the second image of one pair and the first
+        image of the next, instead of being encoded for both pairs. The
+        result is the same as that of predict_pairwise. Images are encoded
+        in batches but, if warm starting is enabled, the pairs of a batch are
+        refined one at a time.
+
+        Args:
+            imgs (list): A list of padded images as tensors of dimension
+                [1, 3, H, W].
+
+        Returns:
+            list: A list of optical flow predictions as tensors of dimension
+                [2, H, W].
+        """
+        warm_start = self.model_cfg.get('warm_start', False)
+        batch_size = self.get_batch_size(*imgs[0].shape[-2:])
+        flows, prev_fmap, flow_init = [], None, None
+        with self.torch.no_grad(), warnings.catch_warnings():
+            warnings.filterwarnings('ignore', category=UserWarning)
+            for i in range(0, len(imgs) - 1, batch_size):
+                num_pairs = len(imgs[i:i + batch_size + 1]) - 1
+                with profile_stage('inference', pairs=num_pairs):
+                    batch = self.normalize(self.torch.cat(
+                        imgs[i:i + batch_size + 1]))
+                    fmaps = self.encode_features(batch if prev_fmap is None
+                                                 else batch[1:])
+                    if prev_fmap is not None:
+                        fmaps = self.torch.cat([prev_fmap, fmaps])
+                    prev_fmap = fmaps[-1:]
+                    net, inp, attention = self.encode_context(batch[:-1])
+                    grps = ([slice(j, j + 1) for j in range(num_pairs)] if
+                            warm_start else [slice(0, num_pairs)])
+                    for grp in grps:
+                        flow_low, flow, num_iters = self.refine(
+                            fmaps[:-1][grp], fmaps[1:][grp], net[grp],
+                            inp[grp], attention[grp], flow_init)
+                        if warm_start:
+                            flow_init = flow_low
+                        flows.extend(flow)
+                        self.num_iters.extend(num_iters)
+
+        return flows
+
+    def normalize(self, imgs):
+        """Normalizes images the same way the GMA network does.
+
+        Args:
+            imgs (torch.Tensor): Images of dimension [N, 3, H, W] with pixel
+                values in 0..255.
+
+        Returns:
+            torch.Tensor: Images with pixel values in -1..1.
+        """
+        return (2 * (imgs / 255.0) - 1.0).contiguous()
+
+    def encode_features(self, imgs):
+        """Runs the GMA feature encoder.
+
+        Args:
+            imgs (torch.Tensor): Normalized images of dimension [N, 3, H, W].
+
+        Returns:
+            torch.Tensor: Feature maps of dimension [N, 256, H / 8, W / 8].
+        """
+        with self.autocast(enabled=self.model.args.mixed_precision):
+            fmaps = self.model.fnet(imgs)
+
+        return fmaps.float()
+
+    def encode_context(self, imgs):
+        """Runs the GMA context encoder and global motion aggregation
+        attention.
+
+        Args:
+            imgs (torch.Tensor): Normalized first images of image pairs, of
+                dimension [N, 3, H, W].
+
+        Returns:
+            tuple: The initial hidden state, context features and attention
+                of the image pairs.
+        """
+        model = self.model
+        with self.autocast(enabled=model.args.mixed_precision):
+            net, inp = self.torch.split(model.cnet(imgs), [
+                model.hidden_dim, model.context_dim], dim=1)
+            net, inp = self.torch.tanh(net), self.torch.relu(inp)
+            attention = model.att(inp)
+
+        return net, inp, attention
+
+    def refine(self, fmap1, fmap2, net, inp, attention, flow_init=None):
+        """Iteratively refines the optical flow of encoded image pairs.
+
+        Mirrors the update loop of the GMA network's forward pass. Runs at
+        most the configured number of iterations and, if a convergence
+        threshold is configured, stops updating an image pair once the mean
+        magnitude of its flow update (in pixels) falls below the threshold.
+
+        Args:
+            fmap1 (torch.Tensor): Feature maps of the first images.
+            fmap2 (torch.Tensor): Feature maps of the second images.
+            net (torch.Tensor): Initial hidden state of the update block.
+            inp (torch.Tensor): Context features of the first images.
+            attention (torch.Tensor): Attention of the first images.
+            flow_init (torch.Tensor, optional): The 1/8 resolution optical
+                flow to start refinement from. Defaults to None.
+
+        Returns:
+            tuple: The 1/8 resolution and upsampled optical flow of the
+                image pairs, and a list of the number of iterations used per
+                image pair.
+        """
+        model = self.model
+        iters = self.model_cfg.get('iters', DEFAULT_ITERS)
+        conv_thresh = self.model_cfg.get('conv_thresh', DEFAULT_CONV_THRESH)
+        corr_fn = self.CorrBlock(fmap1, fmap2, radius=model.args.corr_radius)
+        coords0 = self.coords_grid(*fmap1.shape[:1], *fmap1.shape[2:]).to(
+            fmap1.device)
+        coords1 = coords0.clone()
+        if flow_init is not None:
+            coords1 = coords1 + flow_init
+
+        num_iters = self.torch.full((len(fmap1),), iters)
+        active = self.torch.ones(len(fmap1), dtype=self.torch.bool,
+                                 device=fmap1.device)
+        final_mask = None
+        for i in range(iters):
+            corr = corr_fn(coords1)
+            flow = coords1 - coords0
+            with self.autocast(enabled=model.args.mixed_precision):
+                net, up_mask, delta_flow = model.update_block(
+                    net, inp, corr, flow, attention)
+            delta_flow = delta_flow * active[:, None, None, None]
+            coords1 = coords1 + delta_flow
+            if up_mask is not None:
+                final_mask = (up_mask if final_mask is None else
+                              self.torch.where(active[:, None, None, None],
+                                               up_mask, final_mask))
+
+            if conv_thresh > 0:
+                update = 8 * delta_flow.norm(dim=1).mean(dim=(1, 2))
+                converged = active & (update < conv_thresh)
+                num_iters[converged.cpu()] = i + 1
+                active = active & ~converged
+                if not active.any():
+                    break
+
+        flow_up = (self.upflow8(coords1 - coords0) if final_mask is None else
+                   model.upsample_flow(coords1 - coords0, final_mask))
+
+        return coords1 - coords0, flow_up, num_iters.tolist()
+
+    def get_batch_size(self, hgt, wdh):
+        """Determines the number of image pairs per forward pass.
+
+        Uses the batch size set in the model config, reduced if necessary so
+        that the estimated memory of a forward pass does not exceed the
+        configured memory budget.
+
+        Args:
+            hgt (int): The (padded) height of the images.
+            wdh (int): The (padded) width of the images.
+
+        Returns:
+            int: The number of image pairs per forward pass (at least 1).
+        """
+        batch_size = self.model_cfg.get('batch_size', DEFAULT_BATCH_SIZE)
+        max_mem = self.model_cfg.get('max_batch_mem', DEFAULT_MAX_BATCH_MEM)
+        pair_mem = est_pair_mem(hgt, wdh, self.model_cfg['num_heads'])
+        max_batch_size = int(max_mem * 2 ** 20 // pair_mem)
 
-        return preds
+        return max(1, min(batch_size, max_batch_size))
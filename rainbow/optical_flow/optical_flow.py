@@ -1,3 +1,4 @@
+import logging
 import os
 
 import cv2
@@ -5,20 +6,35 @@ import cv2
 import numpy as np
 
 import rainbow
+from rainbow.manifest import Manifest, is_flow_current
+from rainbow.optical_flow.flow_cache import (get_flow_key, load_cached_flow,
+                                             save_cached_flow)
 from rainbow.optical_flow.model_factory import ModelFactory
-from rainbow.util import (cleanup_dir, save_img_ser, save_img_ser_metadata,
-                          save_optical_flow)
+from rainbow.profiling import profile_stage
+from rainbow.util import (atomic_output, get_flow_path, save_img_ser,
+                          save_img_ser_metadata, save_optical_flow)
 
 OPTICAL_FLOW_FILENAME = 'optical_flow.npy'
+# quantised or compressed optical flow, see rainbow.util.save_optical_flow
+OPTICAL_FLOW_ARCHIVE_FILENAME = 'optical_flow.npz'
+MAX_HUE = 180  # hue of an angle of 2 pi in 8-bit HSV images
+
+logger = logging.getLogger(__name__)
 
 
 def compute_optical_flow(imgs, output_dir, model_name, model_config,
                          reuse_model=True, save_raw_imgs=True,
-                         overwrite_flow=False):
+                         overwrite_flow=False, cache_dir=None,
+                         cache_size=None, flow_encoding='float32',
+                         compress_flow=False, flow_key=None):
     """Computes the optical flow.
 
     Computes the optical flow in an image sequence using the chosen optical
-    flow model and saves the flow as a file in output_dir.
+    flow model and saves the flow as a file in output_dir. If a cache
+    directory is given, optical flow previously computed for the same image
+    sequence pixel data and model configuration is reused instead of being
+    recomputed. output_dir is written atomically, replacing any existing
+    output directory, and its manifest records the optical flow stage.
 
     Args:
         imgs (list): A list of images.
@@ -31,25 +47,55 @@ def compute_optical_flow(imgs, output_dir, model_name, model_config,
         save_raw_imgs (bool, optional): If True, saves the image sequence in
             output_dir. Defaults to True.
         overwrite_flow (bool, optional): If True, will re-compute optical flow
-            even if the flow file already exists in output_dir.
-            Defaults to False.
+            even if up to date optical flow already exists in output_dir or
+            the flow is cached. Defaults to False.
+        cache_dir (string, optional): The path to the optical flow cache
+            directory. If None, no cache is used. Defaults to None.
+        cache_size (float, optional): The maximum size of the optical flow
+            cache in MB. If None, the cache size is unlimited.
+            Defaults to None.
+        flow_encoding (string, optional): The encoding of the saved optical
+            flow, either 'float32', 'float16' or 'int16'.
+            Defaults to 'float32'.
+        compress_flow (bool, optional): If True, losslessly compresses the
+            saved optical flow. Defaults to False.
+        flow_key (string, optional): The key of the optical flow, see
+            rainbow.optical_flow.flow_cache.get_flow_key. If None, it is
+            determined from imgs. Defaults to None.
     """
-    mdl_fcty = ModelFactory()
-    model = mdl_fcty.get_model(model_name, model_config, reuse_model)
-    preds = model.predict(imgs)
-
-    if not (os.path.isfile(os.path.join(output_dir,
-            OPTICAL_FLOW_FILENAME)) and not overwrite_flow):
-        if not cleanup_dir(output_dir):
-            return
-        os.mkdir(output_dir)
-        save_optical_flow(preds, output_dir)
-
+    key = (get_flow_key(imgs, model_name, model_config) if flow_key is None
+           else flow_key)
+    if not overwrite_flow and is_flow_current(output_dir, key):
+        return
+
+    preds = None
+    if cache_dir is not None and not overwrite_flow:
+        preds = load_cached_flow(cache_dir, key)
+    if preds is None:
+        mdl_fcty = ModelFactory()
+        with profile_stage('load_model'):
+            model = mdl_fcty.get_model(model_name, model_config,
+                                       reuse_model)
+        preds = model.predict(imgs)
+        if cache_dir is not None:
+            save_cached_flow(preds, cache_dir, key, cache_size)
+
+    with atomic_output(output_dir, is_dir=True) as tmp_dir:
+        with profile_stage('save_flow', encoding=flow_encoding):
+            max_err = save_optical_flow(preds, tmp_dir, flow_encoding,
+                                        compress_flow)
+        outputs = [os.path.basename(get_flow_path(tmp_dir))]
         if save_raw_imgs:  # TODO remove
-            raw_imgs_dir = os.path.join(output_dir, rainbow.RAW_IMGS_DIR_NAME)
+            raw_imgs_dir = os.path.join(tmp_dir, rainbow.RAW_IMGS_DIR_NAME)
             os.mkdir(raw_imgs_dir)
-            save_img_ser(imgs, raw_imgs_dir)
-            save_img_ser_metadata(imgs, output_dir)
+            with profile_stage('save_raw_imgs', frames=len(imgs)):
+                save_img_ser(imgs, raw_imgs_dir)
+            save_img_ser_metadata(imgs, tmp_dir)
+            outputs += [rainbow.RAW_IMGS_DIR_NAME,
+                        f'{rainbow.METADATA_FILENAME}.json']
+        Manifest(tmp_dir).record('flow', key, outputs)
+    logger.info('Saved optical flow to %s (%s, max encoding error %g px).',
+                output_dir, flow_encoding, max_err)
 
 
 def flow_to_img(flow, normalize=True, info=None, flow_mag_max=None):
@@ -106,3 +152,65 @@ def flow_to_img(flow, normalize=True, info=None, flow_mag_max=None):
         cv2.putText(img, info, (20, 20), font, 0.8, (0, 0, 0), 2, cv2.LINE_AA)
 
     return img
+
+
+def flows_to_imgs(flows, flow_mag_max=None, global_norm=True):
+    """Visualizes the optical flow of an image sequence.
+
+    Sequence-level version of flow_to_img, using the same colour encoding.
+    Flow vector orientation and length are computed in float32 and mapped to
+    RGB through a lookup table of the HSV colours, and the flow vector lengths
+    of all frames can be normalized with a single maximum.
+
+    Args:
+        flows (iterable): The optical flow across an image sequence.
+        flow_mag_max (float, optional): Max flow to map to 255. If None, see
+            global_norm. Defaults to None.
+        global_norm (bool, optional): If True and flow_mag_max is None, maps
+            the maximum flow across the image sequence to 255. If False and
+            flow_mag_max is None, normalizes each frame to 0..255 like
+            flow_to_img. Defaults to True.
+
+    Returns:
+        list: Viewable representations of the dense optical flow in RGB
+            format.
+    """
+    if flow_mag_max is None and global_norm:
+        flow_mag_max = max((float(np.nanmax(cv2.magnitude(flow[..., 0].astype(
+                           np.float32), flow[..., 1].astype(np.float32)),
+                           initial=0)) for flow in flows), default=0)
+    # pack each RGB colour in a uint32 to look up all channels at once
+    lut = np.zeros((MAX_HUE + 1, 256, 4), np.uint8)
+    lut[..., :3] = get_hsv_lut()
+    lut = lut.view(np.uint32).ravel()
+    imgs = []
+    for flow in flows:
+        mag, ang = cv2.cartToPolar(flow[..., 0].astype(np.float32),
+                                   flow[..., 1].astype(np.float32))
+        mag[np.isnan(mag)] = 0
+        hue = (ang * np.float32(MAX_HUE / (2 * np.pi))).astype(np.uint16)
+        if flow_mag_max is None:
+            sat = cv2.normalize(mag, None, 0, 255, cv2.NORM_MINMAX,
+                                cv2.CV_8U)
+        else:
+            sat = cv2.convertScaleAbs(mag, alpha=255 / flow_mag_max if
+                                      flow_mag_max > 0 else 0)
+        img = lut[(hue << 8) | sat].view(np.uint8)
+        imgs.append(np.ascontiguousarray(img.reshape(*sat.shape, 4)[..., :3]))
+
+    return imgs
+
+
+def get_hsv_lut():
+    """Builds a lookup table of the RGB colours of 8-bit HSV colours.
+
+    The colours have a value of 255, as in flow_to_img.
+
+    Returns:
+        numpy.ndarray: The colours as RGB uint8 values with shape
+            [MAX_HUE + 1, 256, 3], indexed by hue and saturation.
+    """
+    hue, sat = np.mgrid[:MAX_HUE + 1, :256].astype(np.uint8)
+    hsv = np.stack([hue, sat, np.full_like(hue, 255)], axis=-1)
+
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
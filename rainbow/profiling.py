@@ -0,0 +1,263 @@
+import cProfile
+import json
+import marshal
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import rainbow
+
+PROFILE_FILE_EXT = '.jsonl'
+CPROFILE_FILE_EXT = '.prof'
+
+# profiling session of the task running in the current thread, if any
+current_session = ContextVar('current_session', default=None)
+
+
+class ProfileSession:
+    """Stage timings of a task of a profiled run.
+
+    While a session is current, each stage entered with profile_stage is
+    recorded with its wall time, CPU time (see get_cpu_time) and the peak
+    resident set size of the process at the end of the stage. The latter is
+    the peak over the lifetime of the process so far, including earlier
+    stages and tasks run by the same worker process, not the peak of the
+    stage itself. Work a stage
+    hands to other threads or processes and does not wait for, e.g. the
+    encoding of video frames while they are rendered, is not included: the
+    video stage only covers waiting for the remaining frames to be encoded
+    once the video is closed. Stages can be nested, e.g. the inference of
+    each batch of image pairs within the optical flow computation. If
+    cprofile_stage is set, the stage with that name is also profiled with
+    cProfile.
+    """
+    def __init__(self, run, task, cprofile_stage=None):
+        """Initializes class instance.
+
+        Args:
+            run (string): The identifier of the profiled run.
+            task (string): The name of the task.
+            cprofile_stage (string, optional): The name of the stage to
+                profile with cProfile. Defaults to None.
+        """
+        self.run, self.task = run, task
+        self.cprofile_stage = cprofile_stage
+        self.records = []
+        self.profiler = None
+
+    def save(self, output_dir):
+        """Appends the recorded stages to the profile of output_dir.
+
+        Records are appended as lines of a .jsonl file, so that tasks of the
+        same output directory running in different processes can save them
+        concurrently. The cProfile statistics, if any, are saved to a new
+        .prof file readable with pstats (or e.g. snakeviz).
+
+        Args:
+            output_dir (string): The path to the output directory.
+        """
+        path = os.path.join(output_dir, rainbow.PROFILE_FILENAME)
+        try:
+            if len(self.records) != 0:
+                with open(path + PROFILE_FILE_EXT, 'a') as f:
+                    f.write(''.join(json.dumps(record) + '\n' for record in
+                                    self.records))
+            if self.profiler is not None:
+                self.profiler.create_stats()
+                for i in range(sys.maxsize):
+                    try:
+                        f = open(f'{path}_{self.cprofile_stage}_{i}'
+                                 f'{CPROFILE_FILE_EXT}', 'xb')
+                        break
+                    except FileExistsError:
+                        pass
+                with f:
+                    marshal.dump(self.profiler.stats, f)
+        except OSError as e:
+            msg = (f'Could not save profile to \'{output_dir}\', reason: '
+                   f'{str(e)}.')
+            warnings.warn(msg, UserWarning)
+
+
+@contextmanager
+def profile_stage(stage, **info):
+    """Records a stage in the current profiling session.
+
+    Does nothing if no session is current, i.e. if the run is not profiled.
+
+    Args:
+        stage (string): The name of the stage.
+        **info: JSON serializable details of the stage to record, e.g. the
+            number of image pairs.
+    """
+    session = current_session.get()
+    if session is None:
+        yield
+        return
+
+    profiler = None
+    if stage == session.cprofile_stage:
+        if session.profiler is None:
+            session.profiler = cProfile.Profile()
+        profiler = session.profiler
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler is active
+            profiler = None
+    start, wall, cpu = time.time(), time.perf_counter(), get_cpu_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, get_cpu_time() - cpu
+        if profiler is not None:
+            profiler.disable()
+        session.records.append({'run': session.run, 'task': session.task,
+                                'stage': stage, 'start': start,
+                                'wall_time': wall, 'cpu_time': cpu,
+                                'process_peak_rss': get_peak_rss(),
+                                **info})
+
+
+def get_cpu_time():
+    """Determines the CPU time used by the current task.
+
+    Tasks running in a thread (e.g. the optical flow computation of the
+    single flow worker, which runs next to image sequence loading and html
+    export threads) use the CPU time of their thread. Tasks running in the
+    main thread of a worker process use the CPU time of the process, which
+    also includes its helper threads (e.g. torch and video encoder threads).
+
+    Returns:
+        float: The CPU time in seconds.
+    """
+    if (threading.current_thread() is threading.main_thread() and
+            multiprocessing.parent_process() is not None):
+        return time.process_time()
+
+    return time.thread_time()
+
+
+def get_peak_rss():
+    """Determines the peak resident set size of the current process.
+
+    The peak is taken over the lifetime of the process so far.
+
+    Returns:
+        float: The peak resident set size in MB, or None if unavailable.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def profile_task(fn, output_dir, profile, *args, **kwargs):
+    """Calls a function within a profiling session.
+
+    The call is recorded as a stage named after the function and the
+    recorded stages are saved to the profile of output_dir once the call
+    has finished, whether it succeeded or failed.
+
+    Args:
+        fn (function): The function to call.
+        output_dir (string): The path to the output directory the call
+            belongs to.
+        profile (dict): The profiled run, with the keys 'run' (its
+            identifier) and 'cprofile_stage' (see ProfileSession).
+        *args: The positional arguments of fn.
+        **kwargs: The keyword arguments of fn.
+
+    Returns:
+        object: The value returned by fn.
+    """
+    session = ProfileSession(profile['run'], fn.__name__,
+                             profile.get('cprofile_stage'))
+    token = current_session.set(session)
+    try:
+        with profile_stage(fn.__name__):
+            return fn(*args, **kwargs)
+    finally:
+        current_session.reset(token)
+        session.save(output_dir)
+
+
+def iter_profiled(items, stage, profile=None):
+    """Iterates over items, recording the production of each as a stage.
+
+    Args:
+        items (iterable): The items, e.g. lazily loaded image sequences.
+        stage (string): The name of the stage.
+        profile (dict, optional): The profiled run, see profile_task. If
+            None, nothing is recorded. Defaults to None.
+
+    Yields:
+        tuple: The next item and the ProfileSession recording its
+            production, or None if profile is None.
+    """
+    items = iter(items)
+    while True:
+        session = (ProfileSession(profile['run'], stage, profile.get(
+                   'cprofile_stage')) if profile is not None else None)
+        token = current_session.set(session)
+        try:
+            with profile_stage(stage):
+                item = next(items)
+        except StopIteration:
+            return
+        finally:
+            current_session.reset(token)
+        yield item, session
+
+
+def summarize_profiles(output_dirs, run):
+    """Summarizes the stages recorded during a profiled run.
+
+    Args:
+        output_dirs (iterable): The paths to the output directories of the
+            run.
+        run (string): The identifier of the run.
+
+    Returns:
+        dict: Per stage, the number of times it ran, its total and maximum
+            wall time and total CPU time (in seconds) and the largest peak
+            resident set size (in MB) reached by a process running it by the
+            end of the stage, see ProfileSession.
+    """
+    summary = defaultdict(lambda: {'count': 0, 'wall_time': 0,
+                                   'max_wall_time': 0, 'cpu_time': 0,
+                                   'process_peak_rss': None})
+    for output_dir in output_dirs:
+        path = os.path.join(output_dir, rainbow.PROFILE_FILENAME +
+                            PROFILE_FILE_EXT)
+        try:
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        except (OSError, ValueError):
+            continue
+        for record in records:
+            if record['run'] != run:
+                continue
+            stage = summary[record['stage']]
+            stage['count'] += 1
+            stage['wall_time'] += record['wall_time']
+            stage['max_wall_time'] = max(stage['max_wall_time'],
+                                         record['wall_time'])
+            stage['cpu_time'] += record['cpu_time']
+            if record['process_peak_rss'] is not None:
+                stage['process_peak_rss'] = max(
+                    stage['process_peak_rss'] or 0,
+                    record['process_peak_rss'])
+
+    return dict(summary)
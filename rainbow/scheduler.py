@@ -0,0 +1,213 @@
+from concurrent.futures import (ALL_COMPLETED, FIRST_COMPLETED,
+                                BrokenExecutor, wait)
+
+RESOURCE_CLASSES = ('model', 'cpu', 'io')
+
+
+class DependencyError(RuntimeError):
+    """Error of a task not run because a task it depends on failed."""
+
+
+class Task:
+    """A function call scheduled by a TaskGraph.
+
+    Once the task has finished, either result holds the value returned by
+    the function or error holds the exception it raised.
+    """
+    def __init__(self, fn, args, kwargs, deps, resource, with_results,
+                 callback, name):
+        """Initializes class instance.
+
+        See TaskGraph.add for a description of the arguments.
+        """
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.deps, self.resource = list(deps), resource
+        self.with_results, self.callback = with_results, callback
+        self.name = name if name is not None else fn.__name__
+        self.num_waiting = 0
+        self.dependents = []
+        self.done = False
+        self.result, self.error = None, None
+
+
+class TaskGraph:
+    """Scheduler of tasks with dependencies.
+
+    Each task belongs to a resource class, model (optical flow inference),
+    cpu (e.g. metrics and rendering) or io (e.g. html export and manifest
+    updates), and runs on the executor of its class once all the tasks it
+    depends on have finished. Tasks of different classes therefore overlap,
+    e.g. the plots of an image sequence are rendered while the optical flow
+    of the next image sequence is computed, and the model is never blocked
+    by report work. Dependents are submitted, and callbacks called, in the
+    thread calling wait.
+
+    A task that raises an exception fails, and so do the tasks depending on
+    it, without stopping the other tasks. If a worker process of an
+    executor dies, the tasks it was running or had queued fail and the
+    executor is replaced for the following tasks.
+    """
+    def __init__(self, executor_fns):
+        """Initializes class instance and starts the executors.
+
+        Args:
+            executor_fns (dict): A function, per resource class, returning a
+                new concurrent.futures.Executor.
+        """
+        self.executor_fns = executor_fns
+        self.executors = {resource: executor_fn() for resource, executor_fn
+                          in executor_fns.items()}
+        self.running = {}
+        self.pending = {resource: 0 for resource in executor_fns}
+
+    def add(self, fn, *args, deps=(), resource='cpu', with_results=False,
+            callback=None, name=None, **kwargs):
+        """Adds a task to the graph.
+
+        The task is submitted once all the tasks it depends on have
+        finished. If one of them has failed, the task fails without being
+        run.
+
+        Args:
+            fn (function): The function to call. It must be picklable if its
+                executor runs it in another process.
+            *args: The positional arguments of fn.
+            deps (iterable, optional): The tasks, or None, the task depends
+                on. Defaults to ().
+            resource (string, optional): The resource class of the task.
+                Defaults to 'cpu'.
+            with_results (bool, optional): If True, the results of the tasks
+                in deps are appended to args. Defaults to False.
+            callback (function, optional): A function called with the task
+                once it has finished, whether it succeeded or failed.
+                Defaults to None.
+            name (string, optional): The name of the task, used in error
+                messages. If None, the name of fn is used. Defaults to None.
+            **kwargs: The keyword arguments of fn.
+
+        Raises:
+            ValueError: If the resource class is not supported.
+
+        Returns:
+            Task: The task.
+        """
+        if resource not in self.executors:
+            msg = f'Chosen resource class ({resource}) not supported.'
+            raise ValueError(msg)
+
+        task = Task(fn, args, kwargs, [dep for dep in deps if dep is not
+                    None], resource, with_results, callback, name)
+        self.pending[resource] += 1
+        for dep in task.deps:
+            if not dep.done:
+                task.num_waiting += 1
+                dep.dependents.append(task)
+        if task.num_waiting == 0:
+            finished = []
+            self.submit(task, finished)
+            self.call_back(finished)
+
+        return task
+
+    def submit(self, task, finished):
+        """Submits a task whose dependencies have finished to its executor.
+
+        A broken executor is replaced before the task is submitted.
+
+        Args:
+            task (Task): The task.
+            finished (list): The list to append the task, and its
+                dependents, to if it fails without being run.
+        """
+        for dep in task.deps:
+            if dep.error is not None:
+                task.error = DependencyError(f'Task {dep.name} it depends '
+                                             'on failed.')
+                self.finish(task, finished)
+                return
+
+        args = task.args + (tuple(dep.result for dep in task.deps) if
+                            task.with_results else ())
+        try:
+            future = self.executors[task.resource].submit(task.fn, *args,
+                                                          **task.kwargs)
+        except BrokenExecutor:
+            self.executors[task.resource].shutdown(wait=False)
+            self.executors[task.resource] = self.executor_fns[
+                task.resource]()
+            future = self.executors[task.resource].submit(task.fn, *args,
+                                                          **task.kwargs)
+        self.running[future] = task
+
+    def finish(self, task, finished):
+        """Marks a task as finished and submits its ready dependents.
+
+        Args:
+            task (Task): The task, with its result or error set.
+            finished (list): The list to append the task, and dependents
+                failing without being run, to.
+        """
+        self.pending[task.resource] -= 1
+        task.done = True
+        finished.append(task)
+        for dependent in task.dependents:
+            dependent.num_waiting -= 1
+            if dependent.num_waiting == 0:
+                self.submit(dependent, finished)
+        task.dependents = []
+
+    def call_back(self, tasks):
+        """Calls the callbacks of finished tasks.
+
+        Args:
+            tasks (list): The finished tasks.
+        """
+        for task in tasks:
+            if task.callback is not None:
+                task.callback(task)
+
+    def num_pending(self, resource=None):
+        """Counts the tasks that have not finished.
+
+        Args:
+            resource (string, optional): The resource class to count the tasks
+                of. If None, all tasks are counted. Defaults to None.
+
+        Returns:
+            int: The number of tasks that are waiting or running.
+        """
+        return (sum(self.pending.values()) if resource is None else
+                self.pending[resource])
+
+    def wait(self, return_when=ALL_COMPLETED):
+        """Waits for tasks to finish and submits their dependents.
+
+        Args:
+            return_when (string, optional): When to return, either
+                concurrent.futures.FIRST_COMPLETED (once at least one task
+                has finished) or ALL_COMPLETED (once all tasks, including
+                dependents submitted meanwhile, have finished).
+                Defaults to ALL_COMPLETED.
+        """
+        while len(self.running) != 0:
+            done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                task = self.running.pop(future)
+                task.error = future.exception()
+                if task.error is None:
+                    task.result = future.result()
+                self.finish(task, finished)
+            self.call_back(finished)
+            if return_when == FIRST_COMPLETED:
+                return
+
+    def shutdown(self, cancel=False):
+        """Shuts down the executors.
+
+        Args:
+            cancel (bool, optional): If True, tasks that have not started are
+                cancelled instead of run. Defaults to False.
+        """
+        for executor in self.executors.values():
+            executor.shutdown(cancel_futures=cancel)
@@ -1,14 +1,20 @@
 import json
 import os
 import shutil
+import subprocess
 import tempfile
 import warnings
+import threading
+import zipfile
+from collections.abc import Sequence
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
+from queue import Full, Queue
 
 import cv2
 
-from moviepy.editor import ImageSequenceClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 
 from natsort import natsorted
 
@@ -19,8 +25,14 @@ import numpy as np
 from pims import Frame
 
 import rainbow
+from rainbow.profiling import profile_stage
 
 VID_FILE_EXT = '.mp4'
+VID_QUEUE_SIZE = 8
+PREFETCH_END = object()
+TMP_PREFIX = '.rainbow_tmp_'
+FLOW_ENCODINGS = ('float32', 'float16', 'int16')
+INT16_MAX = np.iinfo(np.int16).max
 
 
 def load_nd2_imgs(nd2, axs_config, mpp=None):  # mpp None?
@@ -37,44 +49,65 @@ def load_nd2_imgs(nd2, axs_config, mpp=None):  # mpp None?
     Returns:
         list: A list of image sequences loaded from the .nd2 file.
     """
-    frms = ND2Reader(nd2)
-    avl_axs = list(frms.sizes.keys())
-    iter_axs = [ax for ax in axs_config['iter_axs'] if ax in avl_axs]
-    bdl_axs = [ax for ax in axs_config['bdl_axs'] if ax in avl_axs]
-    if len(iter_axs) == 0 or len(bdl_axs) == 0:
-        return []
-    frms.iter_axes, frms.bundle_axes = ''.join(iter_axs), ''.join(bdl_axs)
-    min_px, max_px, ser_len = (0, np.array(list(frms)).max(),
-                               frms.sizes[iter_axs[-1]])
-    imgs, curr_img_ser = [], []
-    for i, frm in enumerate(frms):
-        img = (frm.astype(float) - min_px) * 255.0 / (max_px - min_px)
-        img = np.asarray(img, dtype=np.uint8)
-        img = img[:, :, np.newaxis]
-        img = np.repeat(img, 3, axis=2)
-        frame = Frame(img)
-        frame.metadata = frm.metadata
-        frame.metadata['type'] = '.nd2'
-        frame.metadata['path'] = nd2
-        frame.metadata['img_name'] = 'Image_{}.png'.format(
-            frm.metadata['coords'][axs_config['iter_axs'][-1]])
-        try:
-            frame.metadata['mpp'] = frame.metadata['pixel_microns']
-        except KeyError:
-            frame.metadata['mpp'] = mpp
+    return list(iter_nd2_imgs(nd2, axs_config, mpp))
 
-        curr_img_ser.append(frame)
-        if (i + 1) % ser_len == 0:
-            curr_img_ser[0].metadata['img_ser_md'] = frms.metadata
-            curr_img_ser[0].metadata['img_ser_md']['type'] = '.nd2'
-            curr_img_ser[0].metadata['img_ser_md']['dir'] = os.path.dirname(
-                nd2)
-            imgs.append(curr_img_ser)
-            curr_img_ser = []
 
-    frms.close()
+def iter_nd2_imgs(nd2, axs_config, mpp=None):
+    """Lazily loads image sequences from a .nd2 file.
 
-    return imgs
+    Only one image sequence is held in memory at a time. The maximum pixel
+    value used for normalization is found beforehand by reading the .nd2 file
+    one frame at a time.
+
+    Args:
+        nd2 (string): The path to a .nd2 file.
+        axs_config (dict): A dictionary with the key 'iter_axs', containing a
+            list of the ordered nd2 axes to iterate over, and the key
+            'bdl_axs', containing a list of the axes to bundle when iterating.
+        mpp (float, optional): The micrometres per pixel value of the
+            image sequences, if missing from the .nd2 file. Defaults to None.
+
+    Yields:
+        list: An image sequence loaded from the .nd2 file.
+    """
+    frms = ND2Reader(nd2)
+    try:
+        avl_axs = list(frms.sizes.keys())
+        iter_axs = [ax for ax in axs_config['iter_axs'] if ax in avl_axs]
+        bdl_axs = [ax for ax in axs_config['bdl_axs'] if ax in avl_axs]
+        if len(iter_axs) == 0 or len(bdl_axs) == 0:
+            return
+        frms.iter_axes, frms.bundle_axes = ''.join(iter_axs), ''.join(
+            bdl_axs)
+        min_px, max_px, ser_len = (0, max(frm.max() for frm in frms),
+                                   frms.sizes[iter_axs[-1]])
+        curr_img_ser = []
+        for i, frm in enumerate(frms):
+            img = (frm.astype(float) - min_px) * 255.0 / (max_px - min_px)
+            img = np.asarray(img, dtype=np.uint8)
+            img = img[:, :, np.newaxis]
+            img = np.repeat(img, 3, axis=2)
+            frame = Frame(img)
+            frame.metadata = frm.metadata
+            frame.metadata['type'] = '.nd2'
+            frame.metadata['path'] = nd2
+            frame.metadata['img_name'] = 'Image_{}.png'.format(
+                frm.metadata['coords'][axs_config['iter_axs'][-1]])
+            try:
+                frame.metadata['mpp'] = frame.metadata['pixel_microns']
+            except KeyError:
+                frame.metadata['mpp'] = mpp
+
+            curr_img_ser.append(frame)
+            if (i + 1) % ser_len == 0:
+                curr_img_ser[0].metadata['img_ser_md'] = frms.metadata
+                curr_img_ser[0].metadata['img_ser_md']['type'] = '.nd2'
+                curr_img_ser[0].metadata['img_ser_md']['dir'] = (
+                    os.path.dirname(nd2))
+                yield curr_img_ser
+                curr_img_ser = []
+    finally:
+        frms.close()
 
 
 def load_std_imgs(input_dir, mpp=None):
@@ -91,13 +124,30 @@ def load_std_imgs(input_dir, mpp=None):
     Returns:
         list: A list of images.
     """
+    return list(iter_std_imgs(input_dir, mpp))
+
+
+def iter_std_imgs(input_dir, mpp=None):
+    """Iterates over an image sequence in input_dir, one image at a time.
+
+    Assumes order of image sequence corresponds to naturally sorted image
+    filenames in input_dir.
+
+    Args:
+        input_dir (string): The path to the input directory.
+        mpp (float, optional): The micrometres per pixel value of the
+            image sequence. Defaults to None.
+
+    Yields:
+        PIMS Frame: The next image.
+    """
     try:
         _, _, files = next(os.walk(input_dir))
     except StopIteration:
-        return []
+        return
 
     files = natsorted([os.path.join(input_dir, f) for f in files])
-    imgs = []
+    first = True
     for f in files:
         img = cv2.imread(f)
         if img is not None:
@@ -106,14 +156,13 @@ def load_std_imgs(input_dir, mpp=None):
                 'img_name'], frame.metadata['mpp'] = (Path(f).suffix, f,
                                                       Path(f).name, mpp)  # mp?
 
-            if len(imgs) == 0:
+            if first:
                 frame.metadata['img_ser_md'] = {'type': Path(f).suffix,
                                                 'dir': input_dir,
                                                 'calibration_um': mpp
                                                 }
-            imgs.append(frame)
-
-    return imgs
+                first = False
+            yield frame
 
 
 def save_img_ser(imgs, output_dir, use_metadata_name=True):
@@ -158,6 +207,36 @@ def cleanup_dir(output_dir):
     return True
 
 
+@contextmanager
+def atomic_output(path, is_dir=False):
+    """Writes a file or directory atomically.
+
+    Yields a temporary path, with the same name as path, to write to. Once
+    the block completes, the temporary file or directory replaces path. If
+    the block fails, it is removed and path is left unchanged.
+
+    Args:
+        path (string): The path of the file or directory to write.
+        is_dir (bool, optional): If True, a directory is written and the
+            yielded directory already exists. Defaults to False.
+
+    Yields:
+        string: The temporary path.
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    tmp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=parent)
+    tmp_path = os.path.join(tmp_dir, name)
+    try:
+        if is_dir:
+            os.mkdir(tmp_path)
+        yield tmp_path
+        if is_dir and os.path.isdir(path):
+            os.rename(path, os.path.join(tmp_dir, f'old_{name}'))
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
 def comb_imgs(img1, img2):
     """Horizontally concatenates two images.
 
@@ -189,19 +268,104 @@ def save_video(input_dir, output_path, fps=5):
     Returns:
         bool: If True, video was successfully saved.
     """
-    imgs = load_std_imgs(input_dir)
-    if len(imgs) == 0:
-        return False
+    with VideoWriter(output_path, fps) as video:
+        for img in iter_std_imgs(input_dir):
+            video.write(img)
 
-    temp_report = os.path.join(tempfile.gettempdir(), 'temp_report.log')
-    os.environ['FFREPORT'] = f'file=\"{temp_report}\"'
-    video = ImageSequenceClip([cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in
-                               imgs], fps=fps)
-    video.write_videofile(os.path.join(output_path + VID_FILE_EXT),
-                          logger=None, write_logfile=False)
-    video.close()
+    return video.num_frames != 0
 
-    return True
+
+class VideoWriter:
+    """Streaming .mp4 video writer.
+
+    Frames are encoded in a background thread as they are written, so
+    rendering can continue while previous frames are encoded and several
+    videos can be written at the same time. At most VID_QUEUE_SIZE frames
+    wait to be encoded. The video file is only created once the first frame
+    is written.
+    """
+    def __init__(self, output_path, fps=5):
+        """Initializes class instance and starts the encoding thread.
+
+        Args:
+            output_path (string): The path to write the video to (includes
+                video filename without extension).
+            fps (int, optional): The framerate of the video. Defaults to 5.
+        """
+        self.path = output_path + VID_FILE_EXT
+        self.fps = fps
+        self.num_frames = 0
+        self.err = None
+        self.frames = Queue(VID_QUEUE_SIZE)
+        self.encoder = threading.Thread(target=self.encode, daemon=True)
+        self.encoder.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, frame):
+        """Queues a frame to be encoded.
+
+        Frames with different dimensions to the first frame are resized.
+
+        Args:
+            frame (numpy.ndarray): The frame as a BGR or grayscale image.
+
+        Raises:
+            RuntimeError: If encoding a previous frame failed.
+        """
+        if self.err is not None:
+            raise RuntimeError(f'Could not write video \'{self.path}\'.'
+                               ) from self.err
+        self.frames.put(frame)
+        self.num_frames += 1
+
+    def close(self):
+        """Waits for all frames to be encoded and closes the video.
+
+        Raises:
+            RuntimeError: If encoding a frame failed.
+        """
+        if self.encoder.is_alive():
+            with profile_stage('video', frames=self.num_frames):
+                self.frames.put(PREFETCH_END)
+                self.encoder.join()
+        if self.err is not None:
+            raise RuntimeError(f'Could not write video \'{self.path}\'.'
+                               ) from self.err
+
+    def encode(self):
+        """Encodes queued frames until the video is closed."""
+        writer, dims = None, None
+        try:
+            while True:
+                frame = self.frames.get()
+                if frame is PREFETCH_END:
+                    break
+                if self.err is not None:
+                    continue  # drain the queue so writers are not blocked
+                try:
+                    frame = cv2.cvtColor(np.asarray(frame), cv2.COLOR_BGR2RGB
+                                         if np.ndim(frame) == 3 else
+                                         cv2.COLOR_GRAY2RGB)
+                    if writer is None:
+                        dims = (frame.shape[1], frame.shape[0])
+                        # ffmpeg is killed by SIGPIPE if it logs to a pipe
+                        # that moviepy has closed, so discard its log
+                        writer = FFMPEG_VideoWriter(
+                            self.path, dims, self.fps,
+                            logfile=subprocess.DEVNULL)
+                    elif (frame.shape[1], frame.shape[0]) != dims:
+                        frame = cv2.resize(frame, dims)
+                    writer.write_frame(frame)
+                except Exception as e:
+                    self.err = e
+        finally:
+            if writer is not None:
+                writer.close()
 
 
 def apply_metadata(img1, img2):
@@ -220,33 +384,184 @@ def apply_metadata(img1, img2):
     return img1
 
 
-def save_optical_flow(preds, output_dir):
+def save_optical_flow(preds, output_dir, encoding='float32', compress=False):
     """Saves optical flow predictions to a file in output_dir.
 
+    Uncompressed float32 or float16 predictions are written one at a time to
+    a memory-mapped .npy file (rainbow.OPTICAL_FLOW_FILENAME). Quantised
+    (int16) or compressed predictions are written one at a time to a .npz
+    archive (rainbow.OPTICAL_FLOW_ARCHIVE_FILENAME) with an entry per frame,
+    with quantised predictions scaled per frame so that their largest
+    component maps to the int16 range. Either file is found with
+    get_flow_path.
+
     Args:
         preds (list): A list of optical flow predictions as numpy arrays.
         output_dir (string): The path to the output directory.
+        encoding (string, optional): The encoding of the saved predictions,
+            either 'float32', 'float16' or 'int16'. Defaults to 'float32'.
+        compress (bool, optional): If True, losslessly compresses the saved
+            predictions. Defaults to False.
+
+    Raises:
+        ValueError: The chosen encoding is not supported.
+
+    Returns:
+        float: The maximum absolute error between the saved and original
+            predictions introduced by the encoding.
+    """
+    if encoding not in FLOW_ENCODINGS:
+        msg = f'Chosen optical flow encoding ({encoding}) not supported.'
+        raise ValueError(msg)
+
+    max_err = 0.0
+    if encoding != 'int16' and not compress:
+        flow_path = os.path.join(output_dir, rainbow.OPTICAL_FLOW_FILENAME)
+        flow = np.lib.format.open_memmap(flow_path, mode='w+', dtype=(
+            np.asarray(preds[0]).dtype if encoding == 'float32' else
+            np.float16), shape=(len(preds), *np.shape(preds[0])))
+        for i, pred in enumerate(preds):
+            flow[i] = pred
+            max_err = max(max_err, float(np.abs(flow[i] - pred).max()))
+        flow.flush()
+        del flow
+
+        return max_err
+
+    flow_path = os.path.join(output_dir,
+                             rainbow.OPTICAL_FLOW_ARCHIVE_FILENAME)
+    scales = np.ones(len(preds), dtype=np.float32)
+    with zipfile.ZipFile(flow_path, 'w', zipfile.ZIP_DEFLATED if compress
+                         else zipfile.ZIP_STORED, compresslevel=1) as zf:
+        for i, pred in enumerate(preds):
+            pred = np.asarray(pred)
+            if encoding == 'int16':
+                max_val = float(np.abs(pred).max())
+                scales[i] = max_val / INT16_MAX if max_val > 0 else 1
+                enc_pred = np.round(pred / scales[i]).astype(np.int16)
+                dec_pred = enc_pred * scales[i]
+            else:
+                enc_pred = dec_pred = pred.astype(encoding)
+            max_err = max(max_err, float(np.abs(dec_pred - pred).max()))
+            with zf.open(f'frame_{i}.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, enc_pred, allow_pickle=False)
+        for name, arr in zip(['scales', 'max_err'], [scales, np.array(
+                             max_err)]):
+            with zf.open(f'{name}.npy', 'w') as f:
+                np.lib.format.write_array(f, arr, allow_pickle=False)
+
+    return max_err
+
+
+def get_flow_path(output_dir):
+    """Determines the path to the optical flow saved in output_dir.
+
+    Args:
+        output_dir (string): The path to the output directory.
+
+    Returns:
+        string: The path to the .npz archive if output_dir contains one (see
+            save_optical_flow), otherwise to the .npy file.
     """
-    np.save(os.path.join(output_dir, rainbow.OPTICAL_FLOW_FILENAME),
-            np.array(preds), allow_pickle=False)
+    archive_path = os.path.join(output_dir,
+                                rainbow.OPTICAL_FLOW_ARCHIVE_FILENAME)
+    if os.path.isfile(archive_path):
+        return archive_path
+
+    return os.path.join(output_dir, rainbow.OPTICAL_FLOW_FILENAME)
 
 
 def load_optical_flow(flow_path):
     """Loads optical flow predictions from a file.
 
+    The file is memory-mapped or, if saved as an archive, read one frame at
+    a time, so predictions are only loaded from disk when accessed.
+
     Args:
-        flow_path (string): The path to a .npy file containing saved optical
-            flow predictions.
+        flow_path (string): The path to a .npy file or .npz archive
+            containing saved optical flow predictions, see get_flow_path.
 
     Returns:
-        list: A list of optical flow predictions as numpy arrays.
+        FlowSequence: A list-like sequence of optical flow predictions as
+            float32 numpy arrays.
     """
-    raw_preds = np.load(flow_path)
-    preds = []
-    for i in range(0, raw_preds.shape[0]):
-        preds.append(raw_preds[i, ...])
+    return FlowSequence(flow_path)
 
-    return preds
+
+class FlowSequence(Sequence):
+    """Read-only, list-like sequence of optical flow predictions stored in a
+    memory-mapped .npy file or a .npz archive.
+
+    Indexing with an integer returns a prediction of dimension [H, W, 2] and
+    indexing with a slice returns a list of predictions, as with a list.
+    Predictions are decoded to float32 if saved with another encoding. The
+    file is released with close, or on leaving a with statement.
+    """
+    def __init__(self, flow_path):
+        """Initializes class instance.
+
+        Args:
+            flow_path (string): The path to a .npy file or .npz archive
+                containing saved optical flow predictions.
+        """
+        flow = np.load(flow_path, mmap_mode='r')
+        if isinstance(flow, np.lib.npyio.NpzFile):
+            self.flow, self.archive = None, flow
+            self.scales = flow['scales']
+            self.max_err = float(flow['max_err'])
+        else:
+            self.flow, self.archive, self.scales = flow, None, None
+            self.max_err = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return (self.flow.shape[0] if self.archive is None else
+                len(self.scales))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if not -len(self) <= i < len(self):
+            raise IndexError('FlowSequence index out of range')
+
+        if self.archive is None:
+            pred = np.asarray(self.flow[i])
+            return pred if pred.dtype == np.float32 else pred.astype(
+                np.float32)
+
+        i %= len(self)
+        pred = self.archive[f'frame_{i}']
+        if pred.dtype == np.int16:
+            return pred.astype(np.float32) * self.scales[i]
+
+        return pred.astype(np.float32, copy=False)
+
+    def read_window(self, i, rows, cols):
+        """Reads a spatial window of a prediction.
+
+        Args:
+            i (int): The index of the prediction.
+            rows (slice): The rows of the window.
+            cols (slice): The columns of the window.
+
+        Returns:
+            numpy.array: The window of dimension [rows, cols, 2].
+        """
+        if self.archive is not None:
+            return self[i][rows, cols]
+
+        return np.array(self.flow[i, rows, cols], dtype=np.float32)
+
+    def close(self):
+        """Closes the .npz archive or memory map of the predictions."""
+        if self.archive is not None:
+            self.archive.close()
+        self.flow = self.archive = None
 
 
 def save_img_ser_metadata(imgs, output_dir):
@@ -286,3 +601,60 @@ def video_reshape(vid_path, set_wdh=None):
     cap.release()
 
     return round(dsp_wdh), round(dsp_hgt)
+
+
+def prefetch(items, num_prefetch=1):
+    """Iterates over items ahead of time in a background thread.
+
+    Items are yielded in order, while up to num_prefetch further items are
+    produced in the background, e.g. image sequences are loaded while the
+    optical flow of the current one is computed. Exceptions raised while
+    producing items are re-raised when the corresponding item is reached.
+
+    Args:
+        items (iterable): The items.
+        num_prefetch (int, optional): The maximum number of items to produce
+            ahead of the yielded item. If 0, items are produced on demand.
+            Defaults to 1.
+
+    Yields:
+        The next item.
+    """
+    if num_prefetch < 1:
+        yield from items
+        return
+
+    buf, stop = Queue(num_prefetch), threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                buf.put(entry, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((PREFETCH_END, e))
+        else:
+            put((PREFETCH_END, None))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, err = buf.get()
+            if err is not None:
+                raise err
+            if item is PREFETCH_END:
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
@@ -11,9 +11,9 @@ from astropy.stats import circcorrcoef
 
 import cv2
 
-import numpy as np
+from rainbow.util import load_optical_flow
 
-FLOW_FILE_EXT = '.npy'
+FLOW_FILE_EXTS = ('.npy', '.npz')
 
 
 def process_args():
@@ -44,11 +44,11 @@ def compare_optical_flow(input_dir1, input_dir2):
     flow_files = []
     for input_dir in [input_dir1, input_dir2]:
         flow_files += [os.path.join(input_dir, f) for f in next(os.walk(
-            input_dir))[2] if Path(f).suffix == FLOW_FILE_EXT]
+            input_dir))[2] if Path(f).suffix in FLOW_FILE_EXTS]
     assert len(flow_files) == 2, ('Input directories do not contain one '
-                                  f'optical flow file ({FLOW_FILE_EXT}) each.')
+                                  'optical flow file (.npy or .npz) each.')
 
-    flows = [np.load(f) for f in flow_files]
+    flows = [load_optical_flow(f) for f in flow_files]
     assert len(flows[0]) == len(flows[1]), ('Corresponding image sequences '
                                             'are not the same length.')
 
@@ -18,7 +18,6 @@ REQUIRED_PACKAGES = [
     'imutils',
     'astropy',
     'jupyterlab',
-    'physt',
     'bumpver',
     'Pillow < 9.1.0 ; platform_system=="Darwin"'
 ]
@@ -12,3 +12,5 @@ IMG_SER_DIR = os.path.join(DATA_DIR, 'test_image_series')
 VID_PATH = os.path.join(DATA_DIR, 'test_video.gif')
 ND2_PATH = os.path.join(DATA_DIR, 'test_nd2', 'test_nd2.nd2')
 NOTEBOOK_PATH = os.path.join(DATA_DIR, 'test_notebook.ipynb')
+REPORT_PATH = os.path.abspath(os.path.join(DATA_DIR, '..', '..', 'misc',
+                                           'notebooks', 'report.ipynb'))
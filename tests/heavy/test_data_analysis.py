@@ -3,12 +3,18 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 import os
+from multiprocessing import Queue
 from pathlib import Path
 
+import cv2
+
 import numpy as np
 
-from rainbow.data_analysis import (gen_report, save_heatmaps, save_polar_plots,
-                                   save_quiver_plots)
+from rainbow.data_analysis import (KernelPool, RenderPool, SENTINEL,
+                                   export_html, gen_report, save_heatmaps,
+                                   save_lut_heatmaps, save_polar_plots,
+                                   save_quiver_plots, save_raster_quiver_plots)
+from rainbow.util import VideoWriter
 
 from tests import NOTEBOOK_PATH
 
@@ -23,6 +29,31 @@ def test_save_heatmaps(tmpdir):
     assert files[1] == 'Image_1.png'
 
 
+def test_render_pool(tmpdir):
+    preds = [np.random.uniform(low=-10, high=10, size=(5, 5, 2)) for _ in
+             range(5)]
+    pool = RenderPool(2)
+    try:
+        with VideoWriter(os.path.join(tmpdir, 'heatmaps')) as video:
+            save_heatmaps(preds, tmpdir, dpi=100, video=video, pool=pool)
+    finally:
+        pool.shutdown()
+    files = sorted(next(os.walk(tmpdir))[2])
+    assert files == [f'Image_{i}.png' for i in range(5)] + ['heatmaps.mp4']
+    assert video.num_frames == 5
+
+
+def test_save_lut_heatmaps(tmpdir):
+    preds = [np.random.uniform(low=-10, high=10, size=(5, 6, 2)),
+             np.random.uniform(low=-10, high=10, size=(5, 6, 2))]
+    save_lut_heatmaps(preds, tmpdir)
+    files = next(os.walk(tmpdir))[2]
+    files.sort()
+    assert files[0] == 'Image_0.png'
+    assert files[1] == 'Image_1.png'
+    assert cv2.imread(os.path.join(tmpdir, files[0])).shape == (5, 6, 3)
+
+
 def test_save_quiver_plots(tmpdir):
     preds = [np.random.uniform(low=-10, high=10, size=(5, 5, 2)),
              np.random.uniform(low=-10, high=10, size=(5, 5, 2))]
@@ -33,6 +64,20 @@ def test_save_quiver_plots(tmpdir):
     assert files[1] == 'Image_1.png'
 
 
+def test_save_raster_quiver_plots(tmpdir):
+    preds = [np.random.uniform(low=-10, high=10, size=(50, 60, 2)),
+             np.random.uniform(low=-10, high=10, size=(50, 60, 2))]
+    imgs = [np.zeros((25, 30), np.uint8), np.zeros((25, 30), np.uint8)]
+    save_raster_quiver_plots(preds, tmpdir, step=10, imgs=imgs)
+    files = next(os.walk(tmpdir))[2]
+    files.sort()
+    assert files[0] == 'Image_0.png'
+    assert files[1] == 'Image_1.png'
+    img = cv2.imread(os.path.join(tmpdir, files[0]))
+    assert img.shape == (25, 30, 3)
+    assert img.any()
+
+
 def test_save_polar_plots(tmpdir):
     preds = [np.random.uniform(low=-10, high=10, size=(5, 5, 2)),
              np.random.uniform(low=-10, high=10, size=(5, 5, 2))]
@@ -49,3 +94,22 @@ def test_gen_report(tmpdir):
     files.sort(key=lambda x: Path(x).suffix)
     assert files[0] == f'{Path(NOTEBOOK_PATH).stem}.html'
     assert files[1] == Path(NOTEBOOK_PATH).name
+
+
+def test_gen_report_kernel_pool(tmpdir):
+    kernel_pool = KernelPool(1)
+    html_queue = Queue()
+    output_dirs = [tmpdir.mkdir('a'), tmpdir.mkdir('b')]
+    try:
+        for output_dir in output_dirs:
+            gen_report(output_dir, NOTEBOOK_PATH, kernel_pool=kernel_pool,
+                       html_queue=html_queue)
+    finally:
+        kernel_pool.shutdown()
+    html_queue.put(SENTINEL)
+    assert export_html(html_queue) == 0
+    for output_dir in output_dirs:
+        files = next(os.walk(output_dir))[2]
+        files.sort(key=lambda x: Path(x).suffix)
+        assert files[0] == f'{Path(NOTEBOOK_PATH).stem}.html'
+        assert files[1] == Path(NOTEBOOK_PATH).name
@@ -2,13 +2,16 @@
 #
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
+import json
 import os
 import shutil
 from pathlib import Path
 
 import pytest
 
+from rainbow import PROFILE_FILENAME, PROFILE_SUMMARY_FILENAME
 from rainbow.file_processing import get_output_dir, process_files
+from rainbow.optical_flow.optical_flow import OPTICAL_FLOW_FILENAME
 from rainbow.util import load_nd2_imgs, load_std_imgs
 
 from tests import IMG_SER_DIR, ND2_PATH
@@ -62,7 +65,8 @@ def img_seqs(tmpdir):
 
 def test_process_files(img_dir, config):
     num_wrkrs, subdirs, overwrite_flow = 1, False, True
-    process_files(img_dir, config, num_wrkrs, subdirs, overwrite_flow)
+    assert process_files(img_dir, config, num_wrkrs, subdirs,
+                         overwrite_flow) == []
     output_dir = [os.path.join(img_dir, d) for d in next(os.walk(
                   img_dir))[1]][0]
     _, dirs, files = next(os.walk(output_dir))
@@ -73,6 +77,63 @@ def test_process_files(img_dir, config):
     assert '.ipynb' in file_exts
 
 
+def test_process_files_native_analysis(img_dir, config):
+    num_wrkrs, subdirs, overwrite_flow = 1, False, True
+    config['analysis_engine'] = 'native'
+    process_files(img_dir, config, num_wrkrs, subdirs, overwrite_flow)
+    output_dir = [os.path.join(img_dir, d) for d in next(os.walk(
+                  img_dir))[1]][0]
+    files = next(os.walk(output_dir))[2]
+    assert 'magnitude_stats.csv' in files
+    assert 'direction_stats.csv' in files
+    assert 'magnitude_scatter_plot.png' in files
+    assert '.ipynb' not in [Path(f).suffix for f in files]
+
+
+def test_process_files_flow_workers(img_dir, config):
+    num_wrkrs, subdirs, overwrite_flow, num_flow_wrkrs = 1, False, True, 2
+    process_files(img_dir, config, num_wrkrs, subdirs, overwrite_flow,
+                  num_flow_wrkrs)
+    output_dir = [os.path.join(img_dir, d) for d in next(os.walk(
+                  img_dir))[1]][0]
+    files = next(os.walk(output_dir))[2]
+    assert OPTICAL_FLOW_FILENAME in files
+    assert '.html' in [Path(f).suffix for f in files]
+
+
+def test_process_files_kernel_pool(img_dir, config):
+    num_wrkrs, subdirs, overwrite_flow = 1, False, True
+    config['kernel_pool_size'] = 1
+    config['background_html_export'] = True
+    process_files(img_dir, config, num_wrkrs, subdirs, overwrite_flow)
+    output_dir = [os.path.join(img_dir, d) for d in next(os.walk(
+                  img_dir))[1]][0]
+    file_exts = [Path(f).suffix for f in next(os.walk(output_dir))[2]]
+    assert '.html' in file_exts
+    assert '.ipynb' in file_exts
+
+
+def test_process_files_profile(img_dir, config):
+    num_wrkrs, subdirs, overwrite_flow = 1, False, True
+    config['analysis_engine'] = 'native'
+    process_files(img_dir, config, num_wrkrs, subdirs, overwrite_flow,
+                  profile=True, cprofile_stage='inference')
+    output_dir = [os.path.join(img_dir, d) for d in next(os.walk(
+                  img_dir))[1]][0]
+    with open(os.path.join(output_dir, f'{PROFILE_FILENAME}.jsonl')) as f:
+        stages = {json.loads(line)['stage'] for line in f}
+    assert {'load', 'compute_optical_flow', 'resize_pad', 'inference',
+            'save_flow', 'run_stages', 'metrics', 'heatmaps',
+            'video'} <= stages
+    assert os.path.isfile(os.path.join(output_dir, f'{PROFILE_FILENAME}_'
+                                       'inference_0.prof'))
+    with open(os.path.join(img_dir, f'{PROFILE_SUMMARY_FILENAME}.json')
+              ) as f:
+        summary = json.load(f)
+    assert summary['output_dirs'] == [output_dir]
+    assert stages == set(summary['stages'])
+
+
 def test_get_output_dir(img_seqs, nd2_config):
     imgs = load_std_imgs(img_seqs)
     output_dir = get_output_dir(imgs, nd2_config)
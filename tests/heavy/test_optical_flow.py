@@ -29,18 +29,95 @@ def gma_cfg():
             }
 
 
-def test_gma_predict(gma_cfg):
-    model_factory = ModelFactory()
-    model = model_factory.get_model('gma', gma_cfg, True)
+@pytest.fixture
+def gma(gma_cfg, monkeypatch):
+    model = ModelFactory().get_model('gma', gma_cfg, True)
+    # tests change the configuration of the shared GMA instance, so give each
+    # test its own copy, restored afterwards
+    monkeypatch.setattr(model, 'model_cfg', dict(model.model_cfg))
+    return model
+
+
+def test_gma_predict(gma):
     imgs = load_std_imgs(IMG_SER_DIR)
 
-    preds = model.predict(imgs)
+    preds = gma.predict(imgs)
     assert len(preds) == 2
     for pred in preds:
         assert pred.shape[2] == 2
         assert not np.isnan(preds).any()
 
 
+def test_gma_predict_batched(gma):
+    imgs = load_std_imgs(IMG_SER_DIR)
+
+    gma.model_cfg['batch_size'] = 1
+    preds1 = gma.predict(imgs)
+    gma.model_cfg['batch_size'] = 2
+    preds2 = gma.predict(imgs)
+    assert len(preds1) == len(preds2) == 2
+    for pred1, pred2 in zip(preds1, preds2):
+        assert pred1.shape == pred2.shape
+        assert np.allclose(pred1, pred2, atol=1e-3)
+
+
+def test_gma_predict_cached(gma):
+    imgs = load_std_imgs(IMG_SER_DIR)
+
+    gma.model_cfg['engine'] = 'pairwise'
+    preds1 = gma.predict(imgs)
+    gma.model_cfg['engine'] = 'cached'
+    preds2 = gma.predict(imgs)
+    assert len(preds1) == len(preds2) == 2
+    for pred1, pred2 in zip(preds1, preds2):
+        assert pred1.shape == pred2.shape
+        assert np.allclose(pred1, pred2, atol=1e-3)
+
+
+def test_gma_predict_early_stopping(gma):
+    imgs = load_std_imgs(IMG_SER_DIR)
+
+    gma.model_cfg.update({'engine': 'cached', 'iters': 3,
+                            'conv_thresh': 0})
+    gma.predict(imgs)
+    assert gma.num_iters == [3, 3]
+    gma.model_cfg['conv_thresh'] = float('inf')
+    preds = gma.predict(imgs)
+    assert gma.num_iters == [1, 1]
+    assert len(preds) == 2
+
+
+def test_gma_predict_warm_start(gma):
+    imgs = load_std_imgs(IMG_SER_DIR)
+
+    gma.model_cfg['warm_start'] = True
+    for engine in ['pairwise', 'cached']:
+        gma.model_cfg['engine'] = engine
+        preds = gma.predict(imgs)
+        assert len(preds) == 2
+        assert not np.isnan(preds).any()
+
+
+def test_gma_predict_tiled(gma):
+    imgs = load_std_imgs(IMG_SER_DIR)
+
+    preds1 = gma.predict(imgs)
+    # a single tile covering the images blends to the untiled optical flow
+    gma.model_cfg.update({'tiled': True, 'tile_size': [1024, 1024],
+                          'tile_overlap': 32})
+    preds2 = gma.predict(imgs)
+    gma.model_cfg['tile_size'] = [288, 128]
+    preds3 = gma.predict(imgs)
+    assert len(preds1) == len(preds2) == len(preds3) == 2
+    for pred1, pred2, pred3 in zip(preds1, preds2, preds3):
+        assert pred1.shape == pred2.shape == pred3.shape
+        assert np.allclose(pred1, pred2, atol=1e-3)
+        # tiles see less context, so only expect the blended optical flow to
+        # be closer to the untiled optical flow than its own magnitude
+        assert not np.isnan(pred3).any()
+        assert np.abs(pred3 - pred1).mean() < np.abs(pred1).mean()
+
+
 def test_compute_optical_flow(tmpdir, gma_cfg):
     imgs = load_std_imgs(IMG_SER_DIR)
 
@@ -69,3 +146,19 @@ def test_compute_optical_flow(tmpdir, gma_cfg):
                    f == OPTICAL_FLOW_FILENAME]
     assert len(saved_flow3) == 1
     assert saved_flow1_mtime != os.path.getmtime(saved_flow3[0])
+
+
+def test_compute_optical_flow_cache(tmpdir, gma_cfg):
+    imgs = load_std_imgs(IMG_SER_DIR)
+    cache_dir = os.path.join(tmpdir, 'cache')
+    output_dirs = [os.path.join(tmpdir, f'output_{i}') for i in range(2)]
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', category=UserWarning)
+        for output_dir in output_dirs:
+            compute_optical_flow(imgs, output_dir, 'gma', gma_cfg,
+                                 cache_dir=cache_dir)
+    assert len(next(os.walk(cache_dir))[2]) == 1
+    flows = [np.load(os.path.join(output_dir, OPTICAL_FLOW_FILENAME)) for
+             output_dir in output_dirs]
+    assert np.array_equal(flows[0], flows[1])
@@ -5,9 +5,12 @@
 import os
 from pathlib import Path
 
+import numpy as np
+
 import pytest
 
-from rainbow.util import VID_FILE_EXT, load_nd2_imgs, load_std_imgs, save_video
+from rainbow.util import (VID_FILE_EXT, VideoWriter, load_nd2_imgs,
+                          load_std_imgs, save_video)
 
 from tests import IMG_SER_DIR, ND2_PATH
 
@@ -46,3 +49,19 @@ def test_save_video(tmpdir):
     assert save_video(IMG_SER_DIR, os.path.join(tmpdir, 'test_video'))
     video = os.path.join(tmpdir, next(os.walk(tmpdir))[2][0])
     assert Path(video).suffix == VID_FILE_EXT
+
+
+def test_video_writer(tmpdir):
+    paths = [os.path.join(tmpdir, 'test_video_1'),
+             os.path.join(tmpdir, 'test_video_2')]
+    with VideoWriter(paths[0]) as video1, VideoWriter(paths[1], 1) as video2:
+        for i in range(10):
+            video1.write(np.full((32, 48, 3), i * 20, np.uint8))
+            video2.write(np.full((32, 48), i * 20, np.uint8))
+    for path in paths:
+        assert os.path.getsize(path + VID_FILE_EXT) > 0
+
+    with pytest.raises(RuntimeError):
+        with VideoWriter(os.path.join(tmpdir, 'missing', 'video')) as video:
+            for _ in range(100):
+                video.write(np.zeros((32, 48, 3), np.uint8))
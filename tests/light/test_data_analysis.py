@@ -4,15 +4,28 @@
 # https://opensource.org/licenses/MIT
 import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
 from pathlib import Path
 
+import nbformat
+
 import numpy as np
 
-from rainbow.data_analysis import (gen_base_metrics, gen_stats, save_html,
-                                   save_stats)
+import pytest
+
+from rainbow.data_analysis import (gen_base_metrics, gen_batch_stats,
+                                   gen_polar_hists, gen_stats,
+                                   get_report_params, inject_params,
+                                   iter_base_metrics, run_report, run_stages,
+                                   save_html, save_stats)
+from rainbow.scheduler import TaskGraph
 from rainbow.util import load_std_imgs
 
-from tests import IMG_SER_DIR, NOTEBOOK_PATH
+import scipy.stats
+
+from tests import IMG_SER_DIR, NOTEBOOK_PATH, REPORT_PATH
 
 
 def test_save_html(tmpdir):
@@ -27,6 +40,22 @@ def test_gen_stats():
     assert len(stats) != 0
 
 
+def test_gen_batch_stats():
+    vals = np.random.uniform(0, 360, (3, 4, 5))
+    stats = gen_batch_stats(vals, start=2)
+    assert [s['frame'] for s in stats] == [2, 3, 4]
+    for s, frame in zip(stats, vals):
+        assert s['min'] == frame.min() and s['max'] == frame.max()
+        assert s['mean'] == np.mean(frame)
+        assert s['var'] == scipy.stats.describe(frame, axis=None).variance
+    stats = gen_batch_stats(vals, circ=True)
+    for s, frame in zip(stats, vals):
+        rads = np.deg2rad(frame.ravel())
+        assert s['mean'] == np.rad2deg(scipy.stats.circmean(rads))
+        assert s['std'] == np.rad2deg(scipy.stats.circstd(rads))
+        assert s['var'] == np.rad2deg(scipy.stats.circvar(rads))
+
+
 def test_save_stats(tmpdir):
     vals1 = np.random.randint(0, 100, 5).tolist()
     vals2 = np.random.randint(0, 100, 5).tolist()
@@ -46,3 +75,67 @@ def test_gen_base_metrics():
     assert len(data) > 2
     for vals in data.values():
         assert len(vals) != 0
+
+
+def test_iter_base_metrics():
+    preds = [np.random.uniform(low=-10, high=10, size=(6, 8, 2)),
+             np.random.uniform(low=-10, high=10, size=(6, 8, 2))]
+    metrics = list(iter_base_metrics(iter(preds), 2, (4, 3)))
+    assert [m['mag_stats']['frame'] for m in metrics] == [0, 1]
+    for m, pred in zip(metrics, preds):
+        assert np.isclose(m['mag_stats']['max'],
+                          2 * np.linalg.norm(pred, axis=2).max())
+        assert m['mags'].shape == m['dirns'].shape == (3, 4)
+    assert 'mags' not in next(iter_base_metrics(preds))
+
+
+def test_gen_polar_hists():
+    preds = [np.random.uniform(low=-10, high=10, size=(5, 6, 2)),
+             np.random.uniform(low=-10, high=10, size=(5, 6, 2))]
+    hists, r_edges, phi_edges = gen_polar_hists(preds, 2, num_r_bins=4,
+                                                num_phi_bins=8)
+    assert hists.shape == (2, 4, 8)
+    assert (hists.sum(axis=(1, 2)) == 30).all()
+    assert np.isclose(r_edges[-1], 2 * max(np.linalg.norm(p, axis=2).max()
+                                           for p in preds))
+    assert np.allclose(phi_edges, np.linspace(0, 2 * np.pi, 9))
+
+
+def test_gen_polar_hists_max_mag_from_stats():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        preds = [rng.normal(size=(20, 20, 2)).astype(np.float32) * 5]
+        mpp = rng.uniform(0.1, 2)
+        max_mag = max(metrics['mag_stats']['max'] for metrics in
+                      iter_base_metrics(preds, mpp))
+        hists = gen_polar_hists(preds, mpp, max_mag)[0]
+        assert hists.sum() == 400
+
+
+def test_run_stages_error(tmpdir):
+    graph = TaskGraph({'cpu': partial(ProcessPoolExecutor, 1,
+                                      mp_context=get_context('spawn'))})
+    try:
+        # no optical flow or metadata in tmpdir
+        task = graph.add(run_stages, str(tmpdir), {}, ['stats'])
+        graph.wait()
+    finally:
+        graph.shutdown()
+    assert isinstance(task.error, FileNotFoundError)
+
+
+def test_run_report_error(tmpdir):
+    with pytest.raises(FileNotFoundError):
+        run_report(str(tmpdir), {'report_path': 'missing.ipynb'})
+
+
+def test_inject_params():
+    nb = nbformat.read(REPORT_PATH, as_version=4)
+    idx = [i for i, cell in enumerate(nb.cells) if 'parameters' in
+           cell.metadata.get('tags', [])][0]
+    params = get_report_params({'flow_img_max': 2.5,
+                                'flow_img_norm': 'global'})
+    inject_params(nb, params)
+    namespace = {}
+    exec(nb.cells[idx].source + '\n' + nb.cells[idx + 1].source, namespace)
+    assert {name: namespace[name] for name in params} == params
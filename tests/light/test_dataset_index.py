@@ -0,0 +1,57 @@
+# Copyright (c) 2021 Alphons Gwatimba
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+import json
+import os
+import shutil
+
+import pytest
+
+from rainbow.dataset_index import (get_seq_size, index_img_paths,
+                                   index_std_imgs, order_index)
+from rainbow.util import load_std_imgs
+
+from tests import IMG_SER_DIR
+
+ND2_CONFIG = {'iter_axs': ['v', 't'], 'bdl_axs': ['y', 'x']}
+
+
+@pytest.fixture
+def img_dir(tmpdir):
+    shutil.copytree(IMG_SER_DIR, os.path.join(tmpdir, 'test_img_dir'))
+    return os.path.join(tmpdir, 'test_img_dir')
+
+
+def test_index_std_imgs(img_dir):
+    imgs = load_std_imgs(img_dir)
+    assert index_std_imgs(img_dir) == [{'num_frames': len(imgs),
+                                        'shape': list(imgs[0].shape)}]
+    assert index_std_imgs(os.path.join(img_dir, 'missing')) == []
+
+
+def test_index_img_paths(img_dir, tmpdir):
+    cache_path = os.path.join(tmpdir, 'index.json')
+    index = index_img_paths([img_dir], ND2_CONFIG, cache_path)
+    assert index == [{'path': img_dir, 'seqs': index_std_imgs(img_dir)}]
+
+    # cached entries are reused while the directory is unchanged
+    with open(cache_path) as f:
+        cache = json.load(f)
+    cache[img_dir]['seqs'] = []
+    with open(cache_path, 'w') as f:
+        json.dump(cache, f)
+    assert index_img_paths([img_dir], ND2_CONFIG, cache_path)[0]['seqs'] == []
+    os.remove(os.path.join(img_dir, sorted(os.listdir(img_dir))[0]))
+    assert index_img_paths([img_dir], ND2_CONFIG, cache_path) == [
+        {'path': img_dir, 'seqs': index_std_imgs(img_dir)}]
+
+
+def test_order_index():
+    small = {'path': 'dir10', 'seqs': [{'num_frames': 2, 'shape': [1, 1, 3]}]}
+    large = {'path': 'dir2', 'seqs': [{'num_frames': 2, 'shape': [2, 2, 3]}]}
+    assert get_seq_size(large['seqs'][0]) == 24
+    assert order_index([small, large]) == [large, small]
+    assert order_index([large, small], 'largest') == [large, small]
+    with pytest.raises(ValueError):
+        order_index([small, large], 'smallest')
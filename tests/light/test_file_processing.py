@@ -4,11 +4,17 @@
 # https://opensource.org/licenses/MIT
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import pytest
 
-from rainbow.file_processing import skip_opt_flow
+from rainbow.file_processing import (find_dirs, finish_seqs, get_img_paths,
+                                     skip_opt_flow)
 from rainbow.optical_flow.optical_flow import OPTICAL_FLOW_FILENAME
+from rainbow.scheduler import DependencyError, TaskGraph
+
+from tqdm import tqdm
 
 from tests import IMG_SER_DIR
 
@@ -25,3 +31,34 @@ def test_skip_opt_flow(tmpdir):
     tmpdir.join(OPTICAL_FLOW_FILENAME).write('content')
     assert not skip_opt_flow(tmpdir, True)
     assert skip_opt_flow(tmpdir, False)
+
+
+def test_get_img_paths(img_dir):
+    open(os.path.join(img_dir, 'test.nd2'), 'w').close()
+    img_paths = list(get_img_paths([img_dir]))
+    assert img_paths == [img_dir, os.path.join(img_dir, 'test.nd2')]
+
+
+def test_find_dirs(tmpdir):
+    for d in ('a/b', 'a/out/Raw_Images', 'c', '.hidden'):
+        os.makedirs(os.path.join(tmpdir, d))
+    open(os.path.join(tmpdir, 'a', 'out', OPTICAL_FLOW_FILENAME), 'w').close()
+    assert list(find_dirs(tmpdir)) == [os.path.join(tmpdir, d) for d in (
+        'a', 'a/b', 'c')]
+
+
+def test_finish_seqs(tmpdir):
+    graph = TaskGraph({'cpu': partial(ThreadPoolExecutor, 1)})
+    try:
+        flow = graph.add(lambda: 1 / 0)
+        tasks = [flow, graph.add(print, deps=[flow]), graph.add(print), None]
+        graph.wait()
+    finally:
+        graph.shutdown()
+    failed = []
+    with tqdm(total=2, disable=True) as pbar:
+        assert finish_seqs([(2, tasks, str(tmpdir), None)], pbar,
+                           failed) == []
+    assert failed == tasks[:2]
+    assert isinstance(failed[0].error, ZeroDivisionError)
+    assert isinstance(failed[1].error, DependencyError)
@@ -0,0 +1,40 @@
+# Copyright (c) 2021 Alphons Gwatimba
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+import os
+
+import numpy as np
+
+from rainbow.optical_flow.flow_cache import (get_flow_key, load_cached_flow,
+                                             save_cached_flow)
+from rainbow.util import load_std_imgs
+
+from tests import IMG_SER_DIR
+
+
+def test_get_flow_key():
+    imgs = load_std_imgs(IMG_SER_DIR)
+    cfg = {'model': 'gma-sintel.pth', 'num_heads': 1, 'batch_size': 1}
+    key = get_flow_key(imgs, 'gma', cfg)
+    assert key == get_flow_key([img.copy() for img in imgs], 'gma', cfg)
+    assert key == get_flow_key(imgs, 'gma', {**cfg, 'batch_size': 4})
+    assert key == get_flow_key(imgs, 'gma', {**cfg, 'num_threads': 2})
+    assert key != get_flow_key(imgs, 'gma', {**cfg, 'num_heads': 2})
+    assert key != get_flow_key(imgs[:-1], 'gma', cfg)
+
+
+def test_save_and_load_cached_flow(tmpdir):
+    preds = [np.ones((10, 10, 2), dtype=np.float32)] * 2
+    assert load_cached_flow(tmpdir, 'key') is None
+    save_cached_flow(preds, tmpdir, 'key')
+    assert np.array_equal(load_cached_flow(tmpdir, 'key'), preds)
+
+
+def test_cached_flow_eviction(tmpdir):
+    preds = [np.ones((256, 256, 2), dtype=np.float32)] * 2  # 1 MB
+    save_cached_flow(preds, tmpdir, 'key1')
+    os.utime(os.path.join(tmpdir, 'key1.npy'), (0, 0))
+    save_cached_flow(preds, tmpdir, 'key2', max_size=1.5)
+    assert load_cached_flow(tmpdir, 'key1') is None
+    assert load_cached_flow(tmpdir, 'key2') is not None
@@ -0,0 +1,41 @@
+# Copyright (c) 2021 Alphons Gwatimba
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+import os
+
+from rainbow.manifest import Manifest, get_fingerprint, is_flow_current
+from rainbow.optical_flow.optical_flow import OPTICAL_FLOW_FILENAME
+
+
+def test_get_fingerprint(tmpdir):
+    path = os.path.join(tmpdir, 'input.txt')
+    with open(path, 'w') as f:
+        f.write('a')
+    fprint = get_fingerprint('stage', 1, paths=[tmpdir])
+    assert fprint == get_fingerprint('stage', 1, paths=[tmpdir])
+    assert fprint != get_fingerprint('stage', 2, paths=[tmpdir])
+    with open(path, 'a') as f:
+        f.write('b')
+    assert fprint != get_fingerprint('stage', 1, paths=[tmpdir])
+
+
+def test_manifest(tmpdir):
+    open(os.path.join(tmpdir, 'output.txt'), 'w').close()
+    manifest = Manifest(tmpdir)
+    assert not manifest.is_current('stage', 'fprint')
+    manifest.record('stage', 'fprint', ['output.txt'])
+    manifest = Manifest(tmpdir)
+    assert manifest.is_current('stage', 'fprint')
+    assert not manifest.is_current('stage', 'other')
+    os.remove(os.path.join(tmpdir, 'output.txt'))
+    assert not manifest.is_current('stage', 'fprint')
+
+
+def test_is_flow_current(tmpdir):
+    assert not is_flow_current(tmpdir, 'key')
+    open(os.path.join(tmpdir, OPTICAL_FLOW_FILENAME), 'w').close()
+    assert is_flow_current(tmpdir, 'key')
+    Manifest(tmpdir).record('flow', 'key', [OPTICAL_FLOW_FILENAME])
+    assert is_flow_current(tmpdir, 'key')
+    assert not is_flow_current(tmpdir, 'other')
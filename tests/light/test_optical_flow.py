@@ -7,8 +7,9 @@ import numpy as np
 import pytest
 
 from rainbow.optical_flow.base_model import BaseModel
+from rainbow.optical_flow.gma import est_pair_mem, get_tile_origins
 from rainbow.optical_flow.model_factory import ModelFactory
-from rainbow.optical_flow.optical_flow import flow_to_img
+from rainbow.optical_flow.optical_flow import flow_to_img, flows_to_imgs
 from rainbow.util import load_std_imgs
 
 from tests import IMG_SER_DIR
@@ -63,7 +64,34 @@ def test_base_model_get_img_pairs(test_model):
     assert np.array_equal(img_pairs[1][1], imgs[2])
 
 
+def test_est_pair_mem():
+    assert est_pair_mem(288, 128) > 0
+    assert est_pair_mem(576, 256) > 4 * est_pair_mem(288, 128)
+    assert est_pair_mem(288, 128, 2) > est_pair_mem(288, 128, 1)
+
+
+def test_get_tile_origins():
+    origins = get_tile_origins((704, 504), (288, 200), 32)
+    assert origins[0] == (0, 0)
+    assert origins[-1] == (704 - 288, 504 - 200)
+    assert len(origins) == 9
+    assert get_tile_origins((288, 128), (288, 128), 32) == [(0, 0)]
+    with pytest.raises(ValueError):
+        get_tile_origins((704, 504), (288, 200), 200)
+
+
 def test_flow_to_img():
     flow = np.ones((10, 10, 2))
     assert flow_to_img(flow).shape == (10, 10, 3)
     assert not np.isnan(flow).any()
+
+
+def test_flows_to_imgs():
+    flows = [np.random.uniform(-10, 10, (10, 12, 2)),
+             np.random.uniform(-10, 10, (10, 12, 2))]
+    imgs = flows_to_imgs(flows, global_norm=False)
+    assert len(imgs) == 2
+    for img, flow in zip(imgs, flows):
+        assert img.shape == (10, 12, 3) and img.dtype == np.uint8
+        assert np.abs(img.astype(int) - flow_to_img(flow)).max() <= 8
+    assert (flows_to_imgs([np.zeros((4, 4, 2))])[0] == 255).all()
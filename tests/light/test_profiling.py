@@ -0,0 +1,95 @@
+# Copyright (c) 2021 Alphons Gwatimba
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+import json
+import os
+import pstats
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import rainbow
+from rainbow.profiling import (PROFILE_FILE_EXT, iter_profiled,
+                               profile_stage, profile_task,
+                               summarize_profiles)
+
+PROFILE = {'run': 'run', 'cprofile_stage': 'inner'}
+
+
+def run_stages(num_inner):
+    for i in range(num_inner):
+        with profile_stage('inner', index=i):
+            sum(range(1000))
+
+    return num_inner
+
+
+def fail():
+    with profile_stage('inner'):
+        raise RuntimeError
+
+
+def load_profile(output_dir):
+    with open(os.path.join(output_dir, rainbow.PROFILE_FILENAME +
+                           PROFILE_FILE_EXT)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_profile_stage():
+    with profile_stage('stage'):  # no session, nothing recorded
+        pass
+
+
+def test_profile_task(tmpdir):
+    assert profile_task(run_stages, tmpdir, PROFILE, 2) == 2
+    records = load_profile(tmpdir)
+    assert [(r['task'], r['stage']) for r in records] == [
+        ('run_stages', 'inner'), ('run_stages', 'inner'),
+        ('run_stages', 'run_stages')]
+    assert [r.get('index') for r in records] == [0, 1, None]
+    assert all(r['wall_time'] >= 0 and r['cpu_time'] >= 0 for r in records)
+    assert all('process_peak_rss' in r for r in records)
+    stats = pstats.Stats(os.path.join(tmpdir, f'{rainbow.PROFILE_FILENAME}_'
+                                      'inner_0.prof'))
+    assert stats.total_calls > 0
+
+    with pytest.raises(RuntimeError):
+        profile_task(fail, tmpdir, PROFILE)
+    assert [r['stage'] for r in load_profile(tmpdir)[3:]] == ['inner',
+                                                               'fail']
+    assert os.path.isfile(os.path.join(tmpdir, f'{rainbow.PROFILE_FILENAME}_'
+                                       'inner_1.prof'))
+
+
+def test_profile_task_thread_cpu_time(tmpdir):
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(profile_task, time.sleep, tmpdir, PROFILE,
+                                 0.5)
+        while not future.done():  # keep another thread of the process busy
+            sum(range(1000))
+        future.result()
+    record = load_profile(tmpdir)[0]
+    assert record['wall_time'] >= 0.5
+    assert record['cpu_time'] < 0.1
+
+
+def test_iter_profiled(tmpdir):
+    assert list(iter_profiled([1, 2], 'load')) == [(1, None), (2, None)]
+    items = list(iter_profiled([1, 2], 'load', PROFILE))
+    assert [item for item, _ in items] == [1, 2]
+    items[0][1].save(tmpdir)
+    assert [r['stage'] for r in load_profile(tmpdir)] == ['load']
+
+
+def test_summarize_profiles(tmpdir):
+    profile_task(run_stages, tmpdir, PROFILE, 3)
+    profile_task(run_stages, tmpdir, {'run': 'other'}, 1)
+    summary = summarize_profiles([tmpdir, os.path.join(tmpdir, 'missing')],
+                                 'run')
+    assert set(summary) == {'inner', 'run_stages'}
+    assert summary['inner']['count'] == 3
+    assert summary['run_stages']['count'] == 1
+    assert summary['inner']['wall_time'] <= summary['run_stages'][
+        'wall_time']
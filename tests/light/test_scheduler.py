@@ -0,0 +1,52 @@
+# Copyright (c) 2021 Alphons Gwatimba
+#
+# This software is released under the MIT License.
+# https://opensource.org/licenses/MIT
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+import pytest
+
+from rainbow.scheduler import DependencyError, TaskGraph
+
+
+def test_task_graph():
+    graph = TaskGraph({'model': partial(ThreadPoolExecutor, 1),
+                       'cpu': partial(ThreadPoolExecutor, 2)})
+    order, results = [], []
+    try:
+        flow = graph.add(order.append, 'flow', resource='model')
+        stats = [graph.add(lambda i: order.append(i) or i, i, deps=[flow])
+                 for i in range(3)]
+        graph.add(lambda *res: results.extend(res), deps=stats,
+                  with_results=True, callback=results.append)
+        with pytest.raises(ValueError):
+            graph.add(print, resource='gpu')
+        graph.wait()
+    finally:
+        graph.shutdown()
+    assert order[0] == 'flow'
+    assert sorted(order[1:]) == [0, 1, 2]
+    assert results[:3] == [0, 1, 2]
+    assert results[3].error is None
+    assert graph.num_pending() == 0
+
+
+def test_task_graph_errors():
+    graph = TaskGraph({'cpu': partial(ProcessPoolExecutor, 1,
+                                      mp_context=get_context('spawn'))})
+    failed = []
+    try:
+        crash = graph.add(os._exit, 1, callback=failed.append)
+        dependent = graph.add(abs, -1, deps=[crash], callback=failed.append)
+        graph.wait()
+        task = graph.add(abs, -1)
+        graph.wait()
+    finally:
+        graph.shutdown()
+    assert failed == [crash, dependent]
+    assert crash.error is not None
+    assert isinstance(dependent.error, DependencyError)
+    assert task.error is None and task.result == 1
@@ -11,9 +11,13 @@ import numpy as np
 
 from pims import Frame
 
-from rainbow.optical_flow.optical_flow import OPTICAL_FLOW_FILENAME
-from rainbow.util import (apply_metadata, comb_imgs, load_optical_flow,
-                          load_std_imgs, save_img_ser, save_img_ser_metadata,
+import pytest
+
+from rainbow.optical_flow.optical_flow import (OPTICAL_FLOW_ARCHIVE_FILENAME,
+                                               OPTICAL_FLOW_FILENAME)
+from rainbow.util import (apply_metadata, atomic_output, comb_imgs,
+                          get_flow_path, load_optical_flow, load_std_imgs,
+                          prefetch, save_img_ser, save_img_ser_metadata,
                           save_optical_flow, video_reshape)
 
 from tests import IMG_SER_DIR, VID_PATH
@@ -59,6 +63,45 @@ def test_load_optical_flow(tmpdir):
     assert np.array_equal(preds, load_optical_flow(saved_preds))
 
 
+def test_load_optical_flow_lazily(tmpdir):
+    preds = [np.random.rand(6, 8, 2).astype(np.float32) for _ in range(3)]
+    save_optical_flow(preds, tmpdir)
+    saved_preds = load_optical_flow(os.path.join(tmpdir,
+                                                 OPTICAL_FLOW_FILENAME))
+    assert len(saved_preds) == 3
+    assert np.array_equal(saved_preds[-1], preds[-1])
+    assert np.array_equal(saved_preds[1:], preds[1:])
+    assert np.array_equal(saved_preds.read_window(0, slice(1, 3), slice(
+                          2, 5)), preds[0][1:3, 2:5])
+    with pytest.raises(IndexError):
+        saved_preds[3]
+
+
+def test_save_optical_flow_encodings(tmpdir):
+    preds = [np.random.uniform(-10, 10, (6, 8, 2)).astype(np.float32) for _
+             in range(3)]
+    for encoding, compress, tol in [('float32', True, 0), ('float16', False,
+                                    1e-2), ('float16', True, 1e-2), ('int16',
+                                    False, 1e-3), ('int16', True, 1e-3)]:
+        output_dir = os.path.join(tmpdir, f'{encoding}_{compress}')
+        os.mkdir(output_dir)
+        max_err = save_optical_flow(preds, output_dir, encoding, compress)
+        assert max_err <= tol
+        flow_path = get_flow_path(output_dir)
+        assert next(os.walk(output_dir))[2] == [os.path.basename(flow_path)]
+        if encoding == 'int16' or compress:
+            assert os.path.basename(flow_path) == (
+                OPTICAL_FLOW_ARCHIVE_FILENAME)
+        else:
+            assert isinstance(np.load(flow_path), np.ndarray)
+        with load_optical_flow(flow_path) as saved_preds:
+            assert len(saved_preds) == 3
+            for pred, saved_pred in zip(preds, saved_preds):
+                assert saved_pred.dtype == np.float32
+                assert np.abs(saved_pred - pred).max() <= max_err + 1e-6
+        assert saved_preds.archive is None
+
+
 def test_apply_metadata():
     img1 = np.ones((10, 10, 3))
     _, img2, _ = load_std_imgs(IMG_SER_DIR)
@@ -76,3 +119,37 @@ def test_save_img_ser_metadata(tmpdir):
 
 def test_video_reshape():
     assert video_reshape(VID_PATH, 128) == (128, 54)
+
+
+def test_prefetch():
+    items = list(range(10))
+    for num_prefetch in [0, 1, 3, 20]:
+        assert list(prefetch(iter(items), num_prefetch)) == items
+
+
+def test_prefetch_error():
+    def items():
+        yield 1
+        raise ValueError
+
+    prefetched = prefetch(items(), 2)
+    assert next(prefetched) == 1
+    with pytest.raises(ValueError):
+        next(prefetched)
+
+
+def test_atomic_output(tmpdir):
+    output_dir = os.path.join(tmpdir, 'output')
+    os.mkdir(output_dir)
+    open(os.path.join(output_dir, 'old.txt'), 'w').close()
+    with pytest.raises(RuntimeError):
+        with atomic_output(output_dir, is_dir=True) as tmp_dir:
+            open(os.path.join(tmp_dir, 'new.txt'), 'w').close()
+            raise RuntimeError
+    assert os.listdir(output_dir) == ['old.txt']
+    with atomic_output(output_dir, is_dir=True) as tmp_dir:
+        assert os.path.basename(tmp_dir) == 'output'
+        open(os.path.join(tmp_dir, 'new.txt'), 'w').close()
+        assert os.listdir(output_dir) == ['old.txt']
+    assert os.listdir(output_dir) == ['new.txt']
+    assert os.listdir(tmpdir) == ['output']